@@ -0,0 +1,61 @@
+"""
+Overhead benchmark of BatchesOpenAICompletions against the in-process fake OpenAI server.
+Reports requests per second, batches.retrieve calls per request and peak Python memory (of client and fake server)
+ for a number of concurrent create() calls.
+Run from the repository root: python -m benchmarks.batches_client_benchmark [--concurrency 1 100 10000]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import Optional, Dict, Any
+
+from yid_langchain_extensions.llm.batches_openai_client import BATCH_BUSY_STATUSES
+from yid_langchain_extensions.llm.fake_openai_server import FakeOpenAIServer
+
+
+async def run(
+        concurrency: int, batch_window: Optional[float], poll_interval: float, processing_delay: float
+) -> Dict[str, Any]:
+    server = FakeOpenAIServer(processing_delay=processing_delay, chunk_size=64 * 1024)
+    batches_client = server.batches_client(
+        batch_window=batch_window, poll_intervals=dict.fromkeys(BATCH_BUSY_STATUSES, poll_interval))
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    await asyncio.gather(*(
+        batches_client.create(messages=[{"role": "user", "content": f"request {i}"}], model="gpt-4.1-nano")
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started_at
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "concurrency": concurrency,
+        "batches": server.calls["batches.create"],
+        "requests/s": concurrency / elapsed,
+        "polls/request": server.calls["batches.retrieve"] / concurrency,
+        "peak MiB": peak_memory / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 100, 10_000])
+    parser.add_argument("--batch-window", type=float, default=0.05,
+                        help="coalescing window in seconds, 0 to send each request as its own batch")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--processing-delay", type=float, default=0.2, help="fake batch processing time")
+    args = parser.parse_args()
+
+    columns = ["concurrency", "batches", "requests/s", "polls/request", "peak MiB"]
+    print("".join(f"{column:>15}" for column in columns))
+    for concurrency in args.concurrency:
+        result = asyncio.run(run(concurrency, args.batch_window or None, args.poll_interval, args.processing_delay))
+        print("".join(
+            f"{result[column]:>15.2f}" if isinstance(result[column], float) else f"{result[column]:>15}"
+            for column in columns
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Streaming benchmark of DeepseekR1JsonToolCallsParser on synthetic R1 outputs:
+ a long <think> block followed by a tool call json with long arguments, streamed by ~4 chars (about a token).
+Compares the incremental parser with the cumulative one of BaseCumulativeTransformOutputParser
+ (reparsing the whole accumulated text on every chunk), reporting total time and per-chunk time
+ at the start and at the end of the stream: constant for the incremental parser, growing for the cumulative one.
+Run from the repository root: python -m benchmarks.deepseek_stream_parser_benchmark [--tokens 1000 4000 20000]
+"""
+import argparse
+import json
+import time
+from typing import List, Dict, Any, Callable, Iterator
+
+from langchain_core.output_parsers import BaseCumulativeTransformOutputParser
+
+from yid_langchain_extensions.llm.tools_in_prompt_llm import DeepseekR1JsonToolCallsParser
+
+CHARS_PER_TOKEN = 4
+
+
+def r1_output(tokens: int, thoughts_share: float = 0.75) -> str:
+    thought_chars = int(tokens * CHARS_PER_TOKEN * thoughts_share)
+    argument_chars = tokens * CHARS_PER_TOKEN - thought_chars
+    thoughts = ("Let me think about which tool to call and with which arguments. " * (thought_chars // 64 + 1))
+    arguments = {"query": "word " * (argument_chars // 5), "limit": 10}
+    tool_call = json.dumps({"name": "search", "arguments": arguments})
+    return f"<think>\n{thoughts[:thought_chars]}\n</think>\n```json\n{tool_call}\n```"
+
+
+def timed_chunks(chunks: List[str], timings: List[float]) -> Iterator[str]:
+    for chunk in chunks:
+        started_at = time.perf_counter()
+        yield chunk
+        timings.append(time.perf_counter() - started_at)
+
+
+def run(tokens: int, transform: Callable[[Iterator[str]], Iterator[Any]]) -> Dict[str, Any]:
+    text = r1_output(tokens)
+    chunks = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+    timings: List[float] = []
+    started_at = time.perf_counter()
+    for _ in transform(timed_chunks(chunks, timings)):
+        pass
+    elapsed = time.perf_counter() - started_at
+    tenth = max(len(timings) // 10, 1)
+    return {
+        "tokens": tokens,
+        "total s": elapsed,
+        "first 10% us/chunk": sum(timings[:tenth]) / tenth * 1e6,
+        "last 10% us/chunk": sum(timings[-tenth:]) / tenth * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 4000, 20_000])
+    parser.add_argument("--cumulative-max-tokens", type=int, default=4000,
+                        help="skip the (quadratic) cumulative parser for longer outputs")
+    args = parser.parse_args()
+
+    output_parser = DeepseekR1JsonToolCallsParser()
+    parsers = {
+        "incremental": output_parser._transform,
+        "cumulative": lambda chunks: BaseCumulativeTransformOutputParser._transform(output_parser, chunks),
+    }
+    columns = ["tokens", "total s", "first 10% us/chunk", "last 10% us/chunk"]
+    print(f"{'parser':>15}" + "".join(f"{column:>20}" for column in columns))
+    for tokens in args.tokens:
+        for name, transform in parsers.items():
+            if name == "cumulative" and tokens > args.cumulative_max_tokens:
+                continue
+            result = run(tokens, transform)
+            print(f"{name:>15}" + "".join(
+                f"{result[column]:>20.2f}" if isinstance(result[column], float) else f"{result[column]:>20}"
+                for column in columns
+            ), flush=True)
+
+
+if __name__ == "__main__":
+    main()
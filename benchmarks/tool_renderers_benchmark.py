@@ -0,0 +1,118 @@
+"""
+Prompt size benchmark of tool schema renderers of ModelWithPromptIntroducedTools on a standard set of tools
+ (pydantic models with nested objects, enums, optional and defaulted fields, and @tool functions).
+Reports tokens of the rendered schemas and of the whole tools prompt added by bind_tools (with tool_choice="auto"),
+ and the saving relative to the default repr renderer.
+With --chars, characters are counted instead of tokens (e.g. when tiktoken cannot download its encoding);
+ savings in characters only approximate savings in tokens.
+Run from the repository root: python -m benchmarks.tool_renderers_benchmark [--encoding o200k_base | --chars]
+"""
+import argparse
+from enum import Enum
+from typing import Callable, List, Optional, Literal
+
+import tiktoken
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.tools import tool
+from pydantic import BaseModel, Field
+
+from yid_langchain_extensions.llm.tool_renderers import TOOL_RENDERERS
+from yid_langchain_extensions.llm.tools_cache import DEFAULT_TOOLS_CACHE
+from yid_langchain_extensions.llm.tools_in_prompt_llm import ModelWithPromptIntroducedTools
+
+
+class Unit(str, Enum):
+    celsius = "celsius"
+    fahrenheit = "fahrenheit"
+
+
+class GetWeather(BaseModel):
+    """Returns the current weather and a forecast for a city."""
+    city: str = Field(description="City name, e.g. 'Paris'")
+    unit: Unit = Field(Unit.celsius, description="Temperature unit")
+    days: int = Field(1, description="Number of forecast days, from 1 to 7")
+
+
+class SearchWeb(BaseModel):
+    """Searches the web and returns the most relevant pages."""
+    query: str = Field(description="Search query")
+    max_results: int = Field(5, description="Maximum number of results")
+    site: Optional[str] = Field(None, description="Restrict results to this domain")
+
+
+class Attendee(BaseModel):
+    """Event attendee"""
+    email: str = Field(description="Email address")
+    optional: bool = Field(False, description="Whether the attendance is optional")
+
+
+class CreateCalendarEvent(BaseModel):
+    """Creates an event in the user's calendar and invites attendees."""
+    title: str = Field(description="Event title")
+    start: str = Field(description="Start time in ISO 8601 format")
+    end: str = Field(description="End time in ISO 8601 format")
+    attendees: List[Attendee] = Field(default_factory=list, description="People to invite")
+    location: Optional[str] = Field(None, description="Address or meeting link")
+    reminder_minutes: Optional[int] = Field(None, description="Minutes before the start to remind")
+
+
+class SendEmail(BaseModel):
+    """Sends an email on behalf of the user."""
+    to: List[str] = Field(description="Recipient email addresses")
+    subject: str = Field(description="Email subject")
+    body: str = Field(description="Email body in plain text")
+    cc: Optional[List[str]] = Field(None, description="Carbon copy recipients")
+    priority: Literal["low", "normal", "high"] = Field("normal", description="Email priority")
+
+
+class LookupOrder(BaseModel):
+    """Looks up an order of the customer by its id."""
+    order_id: str = Field(description="Order id, e.g. 'A-12345'")
+    include_items: bool = Field(False, description="Whether to return order items")
+
+
+@tool
+def calculator(expression: str) -> float:
+    """Evaluates an arithmetic expression, e.g. '2 * (3 + 4)'."""
+    raise NotImplementedError
+
+
+@tool
+def translate(text: str, target_language: str, source_language: Optional[str] = None) -> str:
+    """Translates text to the target language (ISO 639-1 code), detecting the source language if not given."""
+    raise NotImplementedError
+
+
+STANDARD_TOOLS = [GetWeather, SearchWeb, CreateCalendarEvent, SendEmail, LookupOrder, calculator, translate]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--encoding", default="o200k_base", help="tiktoken encoding to count tokens with")
+    parser.add_argument("--chars", action="store_true", help="count characters instead of tokens")
+    args = parser.parse_args()
+    if args.chars:
+        unit, count = "chars", len
+    else:
+        encoding = tiktoken.get_encoding(args.encoding)
+        unit, count = "tokens", lambda text: len(encoding.encode(text))
+    run(unit, count)
+
+
+def run(unit: str, count: Callable[[str], int]):
+    openai_tools = [DEFAULT_TOOLS_CACHE.convert(tool) for tool in STANDARD_TOOLS]
+    model = FakeListChatModel(responses=[""])
+    columns = ["renderer", f"schema {unit}", f"prompt {unit}", "saving"]
+    print("".join(f"{column:>15}" for column in columns))
+    baseline = None
+    for name, renderer in TOOL_RENDERERS.items():
+        schema_size = sum(count(renderer(openai_tool)) for openai_tool in openai_tools)
+        bound = ModelWithPromptIntroducedTools.wrap_model(model, tool_renderer=renderer).bind_tools(
+            STANDARD_TOOLS, tool_choice="auto")
+        prompt_size = count(bound.first.invoke("")[-1].content)
+        baseline = baseline or prompt_size
+        print(f"{name:>15}{schema_size:>15}{prompt_size:>15}{1 - prompt_size / baseline:>15.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Callable, List, Any, Optional, Iterator, AsyncIterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+from pydantic import Field
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Offline chat model answering with respond(messages) (n times if n is passed),
+     records sizes of batch calls and all invocations.
+    Async calls are delayed by latencies (in order of calls).
+    Streaming yields the answer by chunk_size characters, streamed_chunks counts chunks consumed per call.
+    """
+
+    respond: Callable[[List[BaseMessage]], str]
+    latencies: List[float] = Field(default_factory=list)
+    calls: List[List[BaseMessage]] = Field(default_factory=list)
+    batch_sizes: List[int] = Field(default_factory=list)
+    chunk_size: int = 4
+    streamed_chunks: List[int] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any
+    ) -> ChatResult:
+        self.calls.append(messages)
+        return ChatResult(generations=[
+            ChatGeneration(message=AIMessage(content=self.respond(messages))) for _ in range(kwargs.get("n") or 1)])
+
+    async def _agenerate(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any
+    ) -> ChatResult:
+        call_index = len(self.calls)
+        result = self._generate(messages, stop, **kwargs)
+        if call_index < len(self.latencies):
+            await asyncio.sleep(self.latencies[call_index])
+        return result
+
+    def _stream(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        self.calls.append(messages)
+        self.streamed_chunks.append(0)
+        answer = self.respond(messages)
+        for start in range(0, len(answer), self.chunk_size):
+            self.streamed_chunks[-1] += 1
+            yield ChatGenerationChunk(message=AIMessageChunk(content=answer[start:start + self.chunk_size]))
+
+    async def _astream(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for chunk in self._stream(messages, stop, **kwargs):
+            await asyncio.sleep(0)
+            yield chunk
+
+    def batch(self, inputs, config=None, **kwargs):
+        self.batch_sizes.append(len(inputs))
+        return super().batch(inputs, config, **kwargs)
+
+    async def abatch(self, inputs, config=None, **kwargs):
+        self.batch_sizes.append(len(inputs))
+        return await super().abatch(inputs, config, **kwargs)
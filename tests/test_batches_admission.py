@@ -0,0 +1,50 @@
+import asyncio
+import unittest
+
+from yid_langchain_extensions.llm.batches_admission import EnqueuedTokensLimiter, estimate_prompt_tokens
+
+
+class TestEstimatePromptTokens(unittest.TestCase):
+    def test_estimate(self):
+        body = {"model": "gpt-4.1-nano", "messages": [
+            {"role": "system", "content": "a" * 40},
+            {"role": "user", "content": [
+                {"type": "text", "text": "b" * 40},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+            ]},
+        ]}
+        self.assertEqual(estimate_prompt_tokens(body), 2 * 4 + 20 + 765)
+
+
+class TestEnqueuedTokensLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_fifo_admission(self):
+        limiter = EnqueuedTokensLimiter({"model": 100})
+        await limiter.acquire("model", 60)
+        await limiter.acquire("other_model", 1000)
+        second = asyncio.create_task(limiter.acquire("model", 60))
+        third = asyncio.create_task(limiter.acquire("model", 10))
+        await asyncio.sleep(0.01)
+        self.assertEqual(limiter.queue_depth, 2)
+        self.assertFalse(third.done())  # fits, but must not overtake the second one
+
+        limiter.release("model", 60)
+        await asyncio.wait_for(asyncio.gather(second, third), 1)
+        self.assertEqual(limiter.enqueued_tokens["model"], 70)
+        self.assertEqual(limiter.queue_depth, 0)
+
+    async def test_oversized_batch_is_admitted_alone(self):
+        limiter = EnqueuedTokensLimiter(100)
+        await asyncio.wait_for(limiter.acquire("model", 1000), 1)
+        self.assertEqual(limiter.stats()["admitted_batches"], 1)
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        limiter = EnqueuedTokensLimiter(100)
+        await limiter.acquire("model", 50)
+        first = asyncio.create_task(limiter.acquire("model", 100))
+        second = asyncio.create_task(limiter.acquire("model", 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        self.assertTrue(second.done())
+        self.assertEqual(limiter.enqueued_tokens["model"], 51)
+        self.assertEqual(limiter.queue_depth, 0)
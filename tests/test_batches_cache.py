@@ -0,0 +1,74 @@
+import asyncio
+import tempfile
+import time
+import unittest
+
+from yid_langchain_extensions.llm.batches_cache import BatchesResponseCache
+
+
+class TestBatchesResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_put(self):
+        cache = BatchesResponseCache(self.directory.name)
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", '{"id": 1}')
+        self.assertEqual(cache.get("key"), '{"id": 1}')
+        cache.close()
+
+    def test_shared_directory(self):
+        writer = BatchesResponseCache(self.directory.name)
+        reader = BatchesResponseCache(self.directory.name)
+        writer.put("key", "value")
+        self.assertEqual(reader.get("key"), "value")
+        writer.close()
+        reader.close()
+
+    def test_ttl(self):
+        cache = BatchesResponseCache(self.directory.name, ttl=0.05)
+        cache.put("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("key"))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = BatchesResponseCache(self.directory.name, max_size_bytes=10)
+        cache.put("a", "1234")
+        cache.put("b", "1234")
+        time.sleep(0.01)
+        cache.get("a")
+        cache.put("c", "1234")
+        self.assertEqual(cache.get("a"), "1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "1234")
+        cache.close()
+
+    def test_total_size_is_tracked(self):
+        cache = BatchesResponseCache(self.directory.name, max_size_bytes=10)
+        cache.put_many([("a", "12"), ("b", "1234")])
+        self.assertEqual(cache.total_size(), 6)
+        time.sleep(0.01)
+        cache.put("a", "1234")
+        self.assertEqual(cache.total_size(), 8)
+        time.sleep(0.01)
+        cache.put("c", "1234")
+        self.assertEqual(cache.total_size(), 8)
+        self.assertIsNone(cache.get("b"))
+        cache.close()
+        reopened = BatchesResponseCache(self.directory.name, max_size_bytes=10)
+        self.assertEqual(reopened.total_size(), 8)
+        reopened.close()
+
+    def test_aput_many(self):
+        async def put():
+            await cache.aput_many([("a", "1"), ("b", "2")])
+
+        cache = BatchesResponseCache(self.directory.name)
+        asyncio.run(put())
+        self.assertEqual((cache.get("a"), cache.get("b")), ("1", "2"))
+        cache.close()
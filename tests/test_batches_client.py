@@ -1,4 +1,9 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 from typing import Tuple
 
 import numpy as np
@@ -6,8 +11,13 @@ from langchain_core.messages import HumanMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+from openai import NotFoundError
 
-from yid_langchain_extensions.llm.batches_openai_client import BatchesOpenAICompletions
+from yid_langchain_extensions.llm.batches_cache import BatchesResponseCache
+from yid_langchain_extensions.llm.batches_journal import BatchesJournal
+from yid_langchain_extensions.llm.batches_openai_client import BatchesOpenAICompletions, BatchRequestError
+from yid_langchain_extensions.llm.fake_openai_server import FakeOpenAIServer, echo_completion, FakeLineError, \
+    fake_batches_llm
 from yid_langchain_extensions.utils import encode_image_to_url
 
 
@@ -68,3 +78,462 @@ class TestBatchesClient(unittest.IsolatedAsyncioTestCase):
             return len(answer) > 0, "Online image test passed"
         except Exception as e:
             return False, f"Online image test failed: {str(e)}"
+
+
+class TestBatchesClientCoalescing(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer()
+
+    async def test_without_window_each_call_is_a_batch(self):
+        llm = self.server.batches_llm()
+        answers = await llm.abatch(["a", "b", "c"])
+        self.assertEqual([answer.content for answer in answers], ["a", "b", "c"])
+        self.assertEqual(self.server.calls["batches.create"], 3)
+
+    async def test_window_coalesces_concurrent_calls(self):
+        llm = self.server.batches_llm(batch_window=0.05)
+        messages = [str(i) for i in range(10)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["files.create"], 1)
+        self.assertEqual(self.server.calls["batches.create"], 1)
+        self.assertEqual(len(self.server.files), 0)
+
+    async def test_window_respects_max_lines(self):
+        llm = self.server.batches_llm(batch_window=10, max_batch_lines=4)
+        messages = [str(i) for i in range(8)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["batches.create"], 2)
+        for requests in self.server.batch_requests.values():
+            self.assertEqual(len(requests), 4)
+
+    async def test_cancelled_requests_are_dropped_from_window(self):
+        llm = self.server.batches_llm(batch_window=0.1)
+        tasks = [asyncio.create_task(llm.ainvoke(message)) for message in ["a", "b", "c"]]
+        await asyncio.sleep(0.02)
+        tasks[1].cancel()
+        answers = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertEqual([answers[0].content, answers[2].content], ["a", "c"])
+        self.assertIsInstance(answers[1], asyncio.CancelledError)
+        [requests] = self.server.batch_requests.values()
+        self.assertEqual([request["body"]["messages"][0]["content"] for request in requests], ["a", "c"])
+
+    async def test_window_without_waiters_is_not_launched(self):
+        llm = self.server.batches_llm(batch_window=0.05)
+        tasks = [asyncio.create_task(llm.ainvoke(message)) for message in ["a", "b"]]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        self.assertNotIn("files.create", self.server.calls)
+        self.assertNotIn("batches.create", self.server.calls)
+
+    async def test_large_output_is_parsed_line_by_line(self):
+        self.server.chunk_size = 7
+        llm = self.server.batches_llm(batch_window=0.05)
+        messages = [f"message {i} " * (i % 5) for i in range(200)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["files.content"], 1)
+
+    async def test_big_batch_is_spilled_to_disk(self):
+        llm = self.server.batches_llm(batch_window=0.05, upload_spool_size=100)
+        messages = [str(i) for i in range(10)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(len(self.server.batch_requests), 1)
+
+    async def test_inline_image(self):
+        llm = self.server.batches_llm(batch_window=0.05)
+        image_url = encode_image_to_url(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8))
+        content = [{'type': 'text', 'text': 'hi'}, {'type': 'image_url', 'image_url': {'url': image_url}}]
+        answer = await llm.ainvoke([HumanMessage(content=content)])
+        self.assertEqual(answer.content, "hi")
+        [request] = self.server.batch_requests.values()
+        self.assertEqual(request[0]["body"]["messages"][0]["content"][1]["image_url"]["url"], image_url)
+
+    async def test_deduplication(self):
+        llm = self.server.batches_llm(batch_window=0.05, deduplicate=True)
+        messages = ["a", "b", "a", "a", "b"]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        [requests] = self.server.batch_requests.values()
+        self.assertEqual(len(requests), 2)
+
+    async def test_no_deduplication_by_default(self):
+        llm = self.server.batches_llm(batch_window=0.05)
+        await llm.abatch(["a", "a"])
+        [requests] = self.server.batch_requests.values()
+        self.assertEqual(len(requests), 2)
+
+    async def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = BatchesResponseCache(cache_dir)
+            answers = await self.server.batches_llm(batch_window=0.05, cache=cache).abatch(["a", "b"])
+            self.assertEqual([answer.content for answer in answers], ["a", "b"])
+            answers = await self.server.batches_llm(batch_window=0.05, cache=cache).abatch(["b", "c", "a"])
+            self.assertEqual([answer.content for answer in answers], ["b", "c", "a"])
+            cache.close()
+        self.assertEqual([len(requests) for requests in self.server.batch_requests.values()], [2, 1])
+
+    async def test_cache_is_written_in_chunks(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch("yid_langchain_extensions.llm.batches_openai_client.CACHE_WRITE_LINES", 2):
+            cache = BatchesResponseCache(cache_dir)
+            messages = ["a", "b", "c", "d", "e"]
+            await self.server.batches_llm(batch_window=0.05, cache=cache).abatch(messages)
+            answers = await self.server.batches_llm(batch_window=0.05, cache=cache).abatch(messages)
+            self.assertEqual([answer.content for answer in answers], messages)
+            cache.close()
+        self.assertEqual(self.server.calls["batches.create"], 1)
+
+    async def test_failed_line_fails_only_its_caller(self):
+        def responder(body):
+            if body["messages"][-1]["content"] == "bad":
+                raise ValueError("bad request")
+            return echo_completion(body)
+
+        self.server.responder = responder
+        llm = self.server.batches_llm(batch_window=0.05)
+        answers = await llm.abatch(["good", "bad"], return_exceptions=True)
+        self.assertEqual(answers[0].content, "good")
+        self.assertIsInstance(answers[1], Exception)
+        self.assertEqual(self.server.calls["batches.create"], 1)
+
+
+class TestBatchesClientPolling(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(retrieves_to_complete=3)
+
+    async def test_poll_volume_grows_with_batches_not_callers(self):
+        llm = self.server.batches_llm(batch_window=0.05)
+        messages = [str(i) for i in range(20)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["batches.create"], 1)
+        self.assertEqual(self.server.calls["batches.retrieve"], 3)
+
+    async def test_one_poller_tracks_many_batches(self):
+        llm = self.server.batches_llm()
+        messages = [str(i) for i in range(5)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["batches.create"], 5)
+        self.assertEqual(self.server.calls["batches.retrieve"], 15)
+
+    async def test_transient_poll_errors_are_retried(self):
+        self.server.retrieve_errors = [429, 500, 503]
+        answer = await self.server.batches_llm().ainvoke("a")
+        self.assertEqual(answer.content, "a")
+        self.assertEqual(self.server.calls["batches.retrieve"], 6)
+
+    async def test_not_found_batch_fails_waiters(self):
+        self.server.retrieve_errors = [404]
+        with self.assertRaises(NotFoundError):
+            await self.server.batches_llm().ainvoke("a")
+        self.assertEqual(self.server.calls["batches.retrieve"], 1)
+
+
+class TestBatchesClientJournal(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(retrieves_to_complete=3)
+        self.journal_dir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.journal_dir.name, "journal.sqlite")
+
+    def tearDown(self):
+        self.journal_dir.cleanup()
+
+    def build_llm(self, journal: BatchesJournal) -> ChatOpenAI:
+        return self.server.batches_llm(batch_window=0.05, journal=journal)
+
+    async def crash_after_launch(self, messages):
+        journal = BatchesJournal(self.journal_path)
+        task = asyncio.create_task(self.build_llm(journal).abatch(messages))
+        while not journal.pending_batch_ids():
+            await asyncio.sleep(0.001)
+        task.cancel()
+        journal.close()
+
+    async def restart(self, messages):
+        journal = BatchesJournal(self.journal_path)
+        answers = await self.build_llm(journal).abatch(messages)
+        leftovers = journal.pending_batch_ids()
+        journal.close()
+        return answers, leftovers
+
+    def test_reissued_requests_are_resolved_from_original_batch(self):
+        messages = ["a", "b", "c"]
+        asyncio.run(self.crash_after_launch(messages))
+        self.assertEqual(self.server.calls["batches.create"], 1)
+
+        answers, leftovers = asyncio.run(self.restart(messages + ["d"]))
+        self.assertEqual([answer.content for answer in answers], ["a", "b", "c", "d"])
+        self.assertEqual(self.server.calls["batches.create"], 2)
+        self.assertEqual([len(requests) for requests in self.server.batch_requests.values()], [3, 1])
+        self.assertEqual(leftovers, [])
+        self.assertEqual(len(self.server.files), 0)
+
+    def test_reattached_batch_retries_failed_lines(self):
+        failures = {"b": [429]}
+
+        def responder(body):
+            message = body["messages"][-1]["content"]
+            if failures.get(message):
+                raise FakeLineError("rate limited", status_code=failures[message].pop(0))
+            return echo_completion(body)
+
+        self.server.responder = responder
+        asyncio.run(self.crash_after_launch(["a", "b"]))
+        answers, leftovers = asyncio.run(self.restart(["a", "b"]))
+        self.assertEqual([answer.content for answer in answers], ["a", "b"])
+        self.assertEqual([len(requests) for requests in self.server.batch_requests.values()], [2, 1])
+        self.assertEqual(leftovers, [])
+
+    def test_result_is_kept_until_reissued(self):
+        asyncio.run(self.crash_after_launch(["a", "b"]))
+        self.server.retrieves_to_complete = 1
+
+        answers, _ = asyncio.run(self.restart(["a"]))
+        self.assertEqual(answers[0].content, "a")
+        answers, _ = asyncio.run(self.restart(["b"]))
+        self.assertEqual(answers[0].content, "b")
+        self.assertEqual(self.server.calls["batches.create"], 1)
+
+    def test_transient_errors_do_not_break_reattach(self):
+        asyncio.run(self.crash_after_launch(["a", "b"]))
+        self.server.retrieve_errors = [500, 429]
+
+        async def reissue_one_by_one():
+            journal = BatchesJournal(self.journal_path)
+            llm = self.build_llm(journal)
+            answers = [await llm.ainvoke("a"), await asyncio.wait_for(llm.ainvoke("b"), 3)]
+            leftovers = journal.pending_batch_ids()
+            journal.close()
+            return answers, leftovers
+
+        answers, leftovers = asyncio.run(reissue_one_by_one())
+        self.assertEqual([answer.content for answer in answers], ["a", "b"])
+        self.assertEqual(leftovers, [])
+        self.assertEqual(self.server.calls["batches.create"], 1)
+
+    def test_purged_batch_is_forgotten_and_requests_resubmitted(self):
+        asyncio.run(self.crash_after_launch(["a", "b"]))
+        self.server.batches.clear()
+        self.server.retrieves_to_complete = 1
+
+        answers, leftovers = asyncio.run(self.restart(["a", "b"]))
+        self.assertEqual([answer.content for answer in answers], ["a", "b"])
+        self.assertEqual(leftovers, [])
+        answers, leftovers = asyncio.run(self.restart(["a"]))
+        self.assertEqual(answers[0].content, "a")
+        self.assertEqual(leftovers, [])
+        self.assertEqual(self.server.calls["batches.create"], 3)
+
+
+class TestBatchesClientSubmitMany(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        def responder(body):
+            if body["messages"][-1]["content"] == "bad":
+                raise ValueError("bad request")
+            return echo_completion(body)
+
+        self.server = FakeOpenAIServer(responder=responder)
+        self.client = self.server.batches_client(max_batch_lines=3)
+
+    async def test_submit_many(self):
+        messages = [str(i) for i in range(10)] + ["bad"]
+        requests = [{"model": "gpt-4.1-nano", "messages": [{"role": "user", "content": message}]}
+                    for message in messages]
+        results = {}
+        async for index, result in self.client.submit_many(requests):
+            self.assertNotIn(index, results)
+            results[index] = result
+
+        self.assertEqual(len(results), len(messages))
+        for index, message in enumerate(messages[:-1]):
+            self.assertEqual(results[index].choices[0].message.content, message)
+        self.assertIsInstance(results[len(messages) - 1], Exception)
+        self.assertEqual(self.server.calls["batches.create"], 4)
+        self.assertTrue(all(len(requests) <= 3 for requests in self.server.batch_requests.values()))
+
+
+class TestBatchesClientPartialFailures(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.failures = {}
+
+        def responder(body):
+            message = body["messages"][-1]["content"]
+            if self.failures.get(message):
+                status_code = self.failures[message].pop(0)
+                raise FakeLineError(f"failed with {status_code}", status_code=status_code)
+            return echo_completion(body)
+
+        self.server = FakeOpenAIServer(responder=responder)
+
+    async def test_only_retryable_lines_are_resubmitted(self):
+        self.failures = {"rate_limited": [429], "broken_server": [500, 503], "invalid": [400]}
+        messages = ["ok", "rate_limited", "broken_server", "invalid", "fine"]
+        answers = await self.server.batches_llm(batch_window=0.05).abatch(messages, return_exceptions=True)
+        self.assertEqual([answer.content for answer in answers if not isinstance(answer, Exception)],
+                         ["ok", "rate_limited", "broken_server", "fine"])
+        self.assertIsInstance(answers[3], BatchRequestError)
+        self.assertEqual(answers[3].status_code, 400)
+        self.assertEqual([len(requests) for requests in self.server.batch_requests.values()], [5, 2, 1])
+        self.assertEqual(len(self.server.files), 0)
+
+    async def test_retries_are_limited(self):
+        self.failures = {"rate_limited": [429, 429]}
+        llm = self.server.batches_llm(batch_window=0.05, max_line_retries=1)
+        answers = await llm.abatch(["ok", "rate_limited"], return_exceptions=True)
+        self.assertEqual(answers[0].content, "ok")
+        self.assertIsInstance(answers[1], BatchRequestError)
+        self.assertEqual(answers[1].status_code, 429)
+        self.assertEqual(self.server.calls["batches.create"], 2)
+
+
+class TestBatchesClientAdmission(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(retrieves_to_complete=2)
+
+    async def test_enqueued_tokens_limit(self):
+        llm = self.server.batches_llm(max_enqueued_tokens={"gpt-4.1-nano": 10})
+        messages = ["a" * 20, "b" * 20, "c" * 20]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        self.assertEqual(self.server.calls["batches.create"], 3)
+        self.assertEqual(self.server.max_active_batches, 1)
+        [stats] = llm.async_client.admission_stats()
+        self.assertEqual(stats["admitted_batches"], 3)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["enqueued_tokens"], {"gpt-4.1-nano": 0})
+        self.assertGreater(stats["average_wait_time"], 0)
+
+    async def test_window_is_split_by_model(self):
+        nano = self.server.batches_llm(batch_window=0.05)
+        mini = nano.model_copy(update={"model_name": "gpt-4.1-mini"})
+        answers = await asyncio.gather(nano.ainvoke("a"), mini.ainvoke("b"), nano.ainvoke("c"))
+        self.assertEqual([answer.content for answer in answers], ["a", "b", "c"])
+        models = sorted(tuple(request["body"]["model"] for request in requests)
+                        for requests in self.server.batch_requests.values())
+        self.assertEqual(models, [("gpt-4.1-mini",), ("gpt-4.1-nano", "gpt-4.1-nano")])
+
+
+class TestBatchesClientPool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.servers = [FakeOpenAIServer(retrieves_to_complete=2), FakeOpenAIServer(retrieves_to_complete=2)]
+
+    def build_llm(self, **kwargs) -> ChatOpenAI:
+        return fake_batches_llm([server.client() for server in self.servers], **kwargs)
+
+    async def test_batches_are_spread_over_clients(self):
+        llm = self.build_llm()
+        messages = [f"message {i}" for i in range(6)]
+        answers = await llm.abatch(messages)
+        self.assertEqual([answer.content for answer in answers], messages)
+        for server in self.servers:
+            self.assertEqual(server.calls["batches.create"], 3)
+            # each batch is polled, downloaded and cleaned up by the client that launched it
+            self.assertEqual(server.calls["batches.retrieve"], 3 * 2)
+            self.assertEqual(server.calls["files.content"], 3)
+            self.assertEqual(server.calls["files.delete"], 3 * 2)
+
+    async def test_client_weights(self):
+        llm = self.build_llm(client_weights=[1, 3])
+        await llm.abatch([f"message {i}" for i in range(8)])
+        self.assertEqual([server.calls["batches.create"] for server in self.servers], [2, 6])
+
+    def test_invalid_client_weights(self):
+        for client_weights in ([1], [1, 2, 3], [1, 0], [1, -1]):
+            with self.subTest(client_weights=client_weights), self.assertRaises(ValueError):
+                BatchesOpenAICompletions([server.client() for server in self.servers], client_weights=client_weights)
+
+    async def test_journal_remembers_owner(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = BatchesJournal(os.path.join(directory, "journal.sqlite"))
+            llm = self.build_llm(journal=journal)
+            task = asyncio.create_task(llm.abatch(["a", "b"]))
+            while len(journal.pending_batch_ids()) < 2:
+                await asyncio.sleep(0.001)
+            owners = {batch_id: journal.client_index(batch_id) for batch_id in journal.pending_batch_ids()}
+            self.assertEqual(
+                owners, {batch_id: i for i, server in enumerate(self.servers) for batch_id in server.batches})
+            await task
+            journal.close()
+
+
+class TestBatchesClientMetrics(unittest.IsolatedAsyncioTestCase):
+    async def test_metrics_hook(self):
+        def responder(body):
+            if body["messages"][-1]["content"] == "bad":
+                raise FakeLineError("invalid request")
+            return echo_completion(body)
+
+        server = FakeOpenAIServer(responder=responder, retrieves_to_complete=2)
+        records = []
+        llm = server.batches_llm(batch_window=0.05, metrics_hook=records.append)
+        answers = await llm.abatch(["a", "b", "bad"], return_exceptions=True)
+        self.assertEqual(answers[0].content, "a")
+        self.assertIsInstance(answers[2], Exception)
+
+        [metrics] = records
+        self.assertEqual(metrics.batch_id, list(server.batches)[0])
+        self.assertEqual(metrics.model, "gpt-4.1-nano")
+        self.assertEqual(metrics.status, "completed")
+        self.assertEqual((metrics.requests, metrics.completed_requests, metrics.failed_requests), (3, 2, 1))
+        self.assertEqual(metrics.polls, 2)
+        self.assertEqual((metrics.prompt_tokens, metrics.completion_tokens), (2, 2))
+        [requests] = server.batch_requests.values()
+        self.assertEqual(
+            metrics.bytes_uploaded, sum(len(json.dumps(request, separators=(",", ":"))) + 1 for request in requests))
+        self.assertGreater(metrics.bytes_downloaded, 0)
+        self.assertEqual(list(metrics.timestamps), [
+            "window_opened", "launched", "admitted", "uploaded", "validating", "in_progress", "completed",
+            "downloaded", "cleaned_up"])
+        durations = metrics.durations()
+        self.assertGreaterEqual(durations["window_opened"], 0.04)
+        self.assertEqual(len(durations), len(metrics.timestamps) - 1)
+
+    async def test_failing_metrics_hook_does_not_skip_cleanup(self):
+        def metrics_hook(metrics):
+            raise RuntimeError("metrics backend is down")
+
+        server = FakeOpenAIServer()
+        llm = server.batches_llm(max_enqueued_tokens={"gpt-4.1-nano": 10}, metrics_hook=metrics_hook)
+        with self.assertLogs("yid_langchain_extensions.llm.batches_openai_client", "ERROR"):
+            answers = await llm.abatch(["a" * 20, "b" * 20])
+        self.assertEqual([answer.content for answer in answers], ["a" * 20, "b" * 20])
+        [stats] = llm.async_client.admission_stats()
+        self.assertEqual(stats["enqueued_tokens"], {"gpt-4.1-nano": 0})
+        self.assertEqual(len(server.files), 0)
+
+
+class TestBatchesClientFakeServerConditions(unittest.IsolatedAsyncioTestCase):
+    async def test_validation_and_processing_delays(self):
+        server = FakeOpenAIServer(validation_delay=0.1, processing_delay=0.1)
+        records = []
+        answer = await server.batches_llm(metrics_hook=records.append).ainvoke("a")
+        self.assertEqual(answer.content, "a")
+        durations = records[0].durations()
+        self.assertGreaterEqual(durations["validating"], 0.09)
+        self.assertGreaterEqual(durations["in_progress"], 0.09)
+
+    async def test_injected_batch_failure(self):
+        server = FakeOpenAIServer(batch_failure_rate=1)
+        answers = await server.batches_llm().abatch(["a", "b"], return_exceptions=True)
+        for answer in answers:
+            self.assertIsInstance(answer, BatchRequestError)
+            self.assertEqual(str(answer), "Injected batch failure")
+        self.assertEqual(server.files, {})
+
+    async def test_injected_http_failures(self):
+        server = FakeOpenAIServer(http_failure_rate=0.3, seed=1)
+        answers = await server.batches_llm().abatch([str(i) for i in range(20)], return_exceptions=True)
+        self.assertGreater(server.calls["http_failures"], 0)
+        failed = [answer for answer in answers if isinstance(answer, Exception)]
+        self.assertGreater(len(failed), 0)
+        self.assertLess(len(failed), 20)
+        for i, answer in enumerate(answers):
+            if not isinstance(answer, Exception):
+                self.assertEqual(answer.content, str(i))
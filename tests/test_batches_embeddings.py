@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+from yid_langchain_extensions.llm.batches_openai_embeddings import BatchesOpenAIEmbeddings
+from yid_langchain_extensions.llm.fake_openai_server import FakeOpenAIServer, embed_inputs, fake_embedding, \
+    FAST_POLL_INTERVALS
+
+
+class TestBatchesEmbeddings(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(responder=embed_inputs, retrieves_to_complete=2)
+        self.batches_client = BatchesOpenAIEmbeddings(
+            self.server.client(), batch_window=0.05, poll_intervals=FAST_POLL_INTERVALS)
+        self.embeddings = OpenAIEmbeddings(
+            model="text-embedding-3-small", api_key="fake", async_client=self.batches_client,
+            check_embedding_ctx_length=False)
+
+    async def test_embed_documents(self):
+        texts = ["first", "second", "third"]
+        vectors = await self.embeddings.aembed_documents(texts)
+        for text, vector in zip(texts, vectors):
+            self.assertIsInstance(vector, np.ndarray)
+            self.assertEqual(vector.dtype, np.float32)
+            np.testing.assert_array_equal(vector, fake_embedding(text))
+        [requests] = self.server.batch_requests.values()
+        self.assertEqual(requests[0]["url"], "/v1/embeddings")
+        self.assertEqual(requests[0]["body"]["encoding_format"], "base64")
+        self.assertEqual(self.server.batches[list(self.server.batches)[0]]["endpoint"], "/v1/embeddings")
+
+    async def test_concurrent_queries_share_a_batch(self):
+        vectors = await asyncio.gather(*(self.embeddings.aembed_query(text) for text in ["a", "b", "c"]))
+        self.assertEqual(len(self.server.batches), 1)
+        np.testing.assert_array_equal(vectors[1], fake_embedding("b"))
+
+    async def test_tokenized_input(self):
+        response = await self.batches_client.create(input=[[1, 2], [3]], model="text-embedding-3-small")
+        self.assertEqual([item["index"] for item in response["data"]], [0, 1])
+        np.testing.assert_array_equal(response["data"][1]["embedding"], fake_embedding("3"))
+        [requests] = self.server.batch_requests.values()
+        self.assertEqual(requests[0]["body"]["input"], [[1, 2], [3]])
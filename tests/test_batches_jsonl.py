@@ -0,0 +1,58 @@
+import base64
+import io
+import json
+import os
+import tracemalloc
+import unittest
+
+from yid_langchain_extensions.llm.batches_jsonl import json_hash, json_size, write_jsonl
+
+
+class NullStream:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.size += len(data)
+
+
+class TestBatchesJsonl(unittest.TestCase):
+    def setUp(self):
+        self.image_url = "data:image/png;base64," + base64.b64encode(os.urandom(3 * 1024 * 1024)).decode()
+        self.request = {
+            "custom_id": "id",
+            "body": {
+                "model": "gpt-4.1-nano",
+                "temperature": 0.5,
+                "stop": None,
+                "messages": [{"role": "user", "content": [
+                    {"type": "text", "text": "what is \"on\" the\nimage? ünïcode"},
+                    {"type": "image_url", "image_url": {"url": self.image_url}},
+                    {"type": "text", "text": "long\n" * 100_000},
+                ]}],
+            },
+        }
+
+    def test_round_trip(self):
+        stream = io.BytesIO()
+        write_jsonl([self.request, {"a": [1, True, {}]}], stream)
+        lines = stream.getvalue().decode().splitlines()
+        self.assertEqual(json.loads(lines[0]), self.request)
+        self.assertEqual(json.loads(lines[1]), {"a": [1, True, {}]})
+        self.assertEqual(json_size(self.request), len(lines[0]))
+
+    def test_hash_does_not_depend_on_key_order(self):
+        reordered = {"body": dict(reversed(list(self.request["body"].items()))), "custom_id": "id"}
+        self.assertEqual(json_hash(self.request), json_hash(reordered))
+        self.assertNotEqual(json_hash(self.request), json_hash({**self.request, "custom_id": "other"}))
+
+    def test_inline_image_is_not_copied_whole(self):
+        request = {"body": {"messages": [{"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": self.image_url}}]}]}}
+        stream = NullStream()
+        tracemalloc.start()
+        write_jsonl([request], stream)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertGreater(stream.size, len(self.image_url))
+        self.assertLess(peak, len(self.image_url) / 10)
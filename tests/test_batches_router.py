@@ -0,0 +1,52 @@
+import asyncio
+import time
+import unittest
+
+from langchain_openai import ChatOpenAI
+
+from yid_langchain_extensions.llm.batches_router import BatchesRouterCompletions
+from yid_langchain_extensions.llm.fake_openai_server import FakeOpenAIServer
+
+
+class TestBatchesRouter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(retrieves_to_complete=2)
+        self.router = BatchesRouterCompletions(self.server.batches_client(), min_batch_time=1, realtime_reserve=0.8)
+        self.llm = ChatOpenAI(
+            model_name="gpt-4.1-nano", temperature=0, api_key="fake",
+            async_client=self.router, callbacks=self.router.callbacks)
+
+    async def test_without_deadline_goes_to_batch(self):
+        answer = await self.llm.ainvoke("a")
+        self.assertEqual(answer.content, "a")
+        self.assertEqual(self.server.calls["batches.create"], 1)
+        self.assertNotIn("chat.completions", self.server.calls)
+
+    async def test_urgent_requests_go_to_realtime(self):
+        answers = await asyncio.gather(
+            self.llm.ainvoke("a", config={"metadata": {"priority": "realtime"}}),
+            self.llm.ainvoke("b", config={"metadata": {"deadline": time.time() + 0.5}}),
+            self.llm.ainvoke("c", config={"metadata": {"deadline": time.time() + 60}}),
+        )
+        self.assertEqual([answer.content for answer in answers], ["a", "b", "c"])
+        self.assertEqual(self.server.calls["chat.completions"], 2)
+        self.assertEqual(self.server.calls["batches.create"], 1)
+        self.assertEqual(self.router.stats, {"realtime": 2, "batch": 1, "fallback": 0})
+
+    async def test_late_batch_falls_back_to_realtime(self):
+        self.server.retrieves_to_complete = 10 ** 6
+        answer = await self.llm.ainvoke("a", config={"metadata": {"deadline": time.time() + 1.1}})
+        self.assertEqual(answer.content, "a")
+        self.assertEqual(self.router.stats, {"realtime": 0, "batch": 1, "fallback": 1})
+        self.assertEqual(self.server.calls["chat.completions"], 1)
+        for _ in range(100):
+            if [batch["status"] for batch in self.server.batches.values()] == ["cancelled"] and not self.server.files:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.server.calls["batches.cancel"], 1)
+        self.assertEqual([batch["status"] for batch in self.server.batches.values()], ["cancelled"])
+        self.assertEqual(self.server.files, {})
+
+    def test_realtime_reserve_must_be_less_than_min_batch_time(self):
+        with self.assertRaises(ValueError):
+            BatchesRouterCompletions(self.router.batches, min_batch_time=60, realtime_reserve=60)
@@ -0,0 +1,53 @@
+import json
+import unittest
+
+from yid_langchain_extensions.llm.output_repair import (
+    OutputRepairer, extract_json, double_quote_strings, remove_trailing_commas, quote_bare_words, wrap_in_list)
+
+
+class TestRepairs(unittest.TestCase):
+    def test_extract_json(self):
+        self.assertEqual(extract_json('Sure:\n```json\n{"a": 1}\n```\nDone.'), '{"a": 1}')
+        self.assertEqual(extract_json('The call is [{"a": 1}] as requested'), '[{"a": 1}]')
+
+    def test_double_quote_strings(self):
+        self.assertEqual(json.loads(double_quote_strings("{'a': 'it\\'s \"quoted\"'}")), {"a": 'it\'s "quoted"'})
+
+    def test_remove_trailing_commas(self):
+        self.assertEqual(json.loads(remove_trailing_commas('{"a": [1, 2,], "b": "x,}",\n}')), {"a": [1, 2], "b": "x,}"})
+
+    def test_quote_bare_words(self):
+        self.assertEqual(
+            json.loads(quote_bare_words('{a: int_value, "b": True, "c": None, "d": 1e5, "e": "None"}')),
+            {"a": "int_value", "b": True, "c": None, "d": 1e5, "e": "None"})
+
+    def test_wrap_in_list(self):
+        self.assertEqual(wrap_in_list(' {"a": 1}'), '[{"a": 1}]')
+        self.assertEqual(wrap_in_list('[{"a": 1}]'), '[{"a": 1}]')
+
+
+class TestOutputRepairer(unittest.TestCase):
+    def test_repair_and_stats(self):
+        repairer = OutputRepairer()
+        text = '```json\n[\n  {\n    "name": "tool1_name",\n    "arguments": {"x": int_value,},\n  },\n]\n```'
+        self.assertEqual(
+            repairer.repair(text, json.loads, ValueError()),
+            [{"name": "tool1_name", "arguments": {"x": "int_value"}}])
+
+        def parse_list(text):
+            result = json.loads(text)
+            if not isinstance(result, list):
+                raise ValueError("list expected")
+            return result
+
+        self.assertEqual(repairer.repair('{"a": 1}', parse_list, ValueError()), [{"a": 1}])
+        error = ValueError("original error")
+        with self.assertRaises(ValueError) as context:
+            repairer.repair("no json here", json.loads, error)
+        self.assertIs(context.exception, error)
+
+        stats = repairer.stats()
+        self.assertEqual((stats["attempts"], stats["repaired"]), (3, 2))
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+        self.assertEqual(stats["hits"]["remove_trailing_commas"], 1)
+        self.assertEqual(stats["hits"]["wrap_in_list"], 1)
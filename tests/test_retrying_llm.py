@@ -1,11 +1,17 @@
+import time
 import unittest
 
+from langchain_core.exceptions import OutputParserException
 from langchain_core.messages import AIMessage, HumanMessage
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.output_parsers import PydanticOutputParser, JsonOutputParser, StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel
 
+from tests.fake_chat_model import ScriptedChatModel
+from yid_langchain_extensions.llm.output_repair import OutputRepairer
 from yid_langchain_extensions.llm.retrying_llm import LLMWithParsingRetry
+from yid_langchain_extensions.llm.stream_validation import JsonStreamValidator
 
 
 class Dot(BaseModel):
@@ -42,3 +48,208 @@ class TestRetryingLLMAsync(unittest.IsolatedAsyncioTestCase):
 
         answer: AIMessage = await retrying_llm.ainvoke([HumanMessage(content="return json call of function Dot(2,7)")])
         self.assertEqual(answer, Dot(a=2, b=7))
+
+
+def respond_after_reformats(messages) -> str:
+    """Answers "<n> <text>" prompts with valid Dot JSON only after n reformat requests."""
+    needed_reformats = int(messages[0].content.split()[0])
+    reformats = sum(message.content.count("RE-FORMAT") for message in messages)
+    return '{"a": 2, "b": 7}' if reformats >= needed_reformats else "Dot(a=2, b=7)"
+
+
+class TestRetryingLLMBatch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.llm = ScriptedChatModel(respond=respond_after_reformats)
+        self.retrying_llm = LLMWithParsingRetry(
+            llm=self.llm, parser=PydanticOutputParser(pydantic_object=Dot), max_retries=2)
+        self.inputs = ["0 ok", "1 retry once", "5 never", "2 retry twice"]
+
+    def check_results(self, results):
+        self.assertEqual(results[0], Dot(a=2, b=7))
+        self.assertEqual(results[1], Dot(a=2, b=7))
+        self.assertIsInstance(results[2], OutputParserException)
+        self.assertEqual(results[3], Dot(a=2, b=7))
+        self.assertEqual(self.llm.batch_sizes, [4, 3, 2])
+
+    def test_batch_waves(self):
+        self.check_results(self.retrying_llm.batch(self.inputs, return_exceptions=True))
+
+    async def test_abatch_waves(self):
+        self.check_results(await self.retrying_llm.abatch(self.inputs, return_exceptions=True))
+
+    async def test_abatch_raises(self):
+        with self.assertRaises(OutputParserException):
+            await self.retrying_llm.abatch(self.inputs)
+        self.assertEqual(await self.retrying_llm.abatch(["0 ok", "1 retry once"]), [Dot(a=2, b=7)] * 2)
+
+
+class TestRetryingLLMRepair(unittest.IsolatedAsyncioTestCase):
+    async def test_repair_avoids_retry(self):
+        llm = ScriptedChatModel(respond=lambda messages: "```json\n{'a': 2, 'b': 7,}\n```")
+        repairer = OutputRepairer()
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), max_retries=2, repairer=repairer)
+        self.assertEqual(await retrying_llm.ainvoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(retrying_llm.invoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(await retrying_llm.abatch(["dot"]), [Dot(a=2, b=7)])
+        self.assertEqual(len(llm.calls), 3)
+        self.assertEqual(repairer.stats()["repaired"], 3)
+
+    async def test_unrepairable_output_is_retried(self):
+        retrying_llm = LLMWithParsingRetry(
+            llm=ScriptedChatModel(respond=respond_after_reformats), parser=PydanticOutputParser(pydantic_object=Dot),
+            max_retries=2, repairer=OutputRepairer())
+        self.assertEqual(await retrying_llm.ainvoke("1 retry once"), Dot(a=2, b=7))
+        self.assertEqual(len(retrying_llm.llm.calls), 2)
+
+
+class TestRetryingLLMCompactRetries(unittest.IsolatedAsyncioTestCase):
+    async def test_compact_retries_go_to_repair_llm(self):
+        llm = ScriptedChatModel(respond=lambda messages: "Dot(a=2, b=7)")
+        repair_llm = ScriptedChatModel(
+            respond=lambda messages: '{"a": 2, "b": 7}' if len(repair_llm.calls) > 1 else "still Dot(a=2, b=7)")
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), max_retries=2,
+            repair_llm=repair_llm, compact_retries=True)
+        long_input = "very long context " * 1000 + "return Dot(2, 7)"
+
+        self.assertEqual(await retrying_llm.ainvoke(long_input), Dot(a=2, b=7))
+        self.assertEqual(len(llm.calls), 1)
+        self.assertEqual(len(repair_llm.calls), 2)
+        for messages, bad_output in zip(repair_llm.calls, ["Dot(a=2, b=7)", "still Dot(a=2, b=7)"]):
+            [message] = messages
+            self.assertNotIn("very long context", message.content)
+            self.assertIn(f"Answer:\n{bad_output}\n", message.content)
+            self.assertIn('"properties"', message.content)  # format instructions of the parser
+
+    async def test_compact_retries_with_composed_parser(self):
+        def to_dot(text: str) -> Dot:
+            return Dot.model_validate_json(text)
+
+        llm = ScriptedChatModel(respond=lambda messages: "Dot(a=2, b=7)")
+        repair_llm = ScriptedChatModel(respond=lambda messages: '{"a": 2, "b": 7}')
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=StrOutputParser() | RunnableLambda(to_dot), max_retries=1,
+            exceptions_to_retry=(ValueError,), repair_llm=repair_llm, compact_retries=True)
+
+        self.assertEqual(await retrying_llm.ainvoke("return Dot(2, 7)"), Dot(a=2, b=7))
+        [[message]] = repair_llm.calls
+        self.assertIn("(see the error message)", message.content)
+
+
+class TestRetryingLLMHedging(unittest.IsolatedAsyncioTestCase):
+    async def test_delayed_hedge_wins_over_slow_attempt(self):
+        llm = ScriptedChatModel(respond=lambda messages: '{"a": 2, "b": 7}', latencies=[5, 0])
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), hedges=2, hedge_delay=0.05)
+        started_at = time.monotonic()
+        self.assertEqual(await retrying_llm.ainvoke("dot"), Dot(a=2, b=7))
+        self.assertLess(time.monotonic() - started_at, 1)
+        self.assertEqual(len(llm.calls), 2)
+        stats = retrying_llm.hedge_stats()
+        self.assertEqual(stats["hedge_wins"], {1: 1})
+        self.assertEqual(stats["hedge_win_rate"], 1.0)
+
+    async def test_failed_attempt_launches_next_hedge(self):
+        llm = ScriptedChatModel(
+            respond=lambda messages: "garbage" if len(llm.calls) == 1 else '{"a": 2, "b": 7}', latencies=[0, 0.05])
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), max_retries=0, hedges=3, hedge_delay=10)
+        self.assertEqual(await retrying_llm.ainvoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(len(llm.calls), 2)
+        self.assertEqual(retrying_llm.hedge_stats()["hedge_wins"], {1: 1})
+
+    async def test_all_hedges_fail(self):
+        llm = ScriptedChatModel(respond=lambda messages: "garbage")
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), max_retries=1, hedges=2)
+        with self.assertRaises(OutputParserException):
+            await retrying_llm.ainvoke("dot")
+        self.assertEqual(len(llm.calls), 4)
+
+    async def test_candidates(self):
+        llm = ScriptedChatModel(respond=lambda messages: next(answers))
+        answers = iter(["garbage", "Dot(2, 7)", '{"a": 2, "b": 7}'])
+        retrying_llm = LLMWithParsingRetry(
+            llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), candidates=3)
+        self.assertEqual(await retrying_llm.ainvoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(len(llm.calls), 1)
+        stats = retrying_llm.hedge_stats()
+        self.assertEqual(stats["candidate_wins"], {2: 1})
+        self.assertEqual(stats["candidate_win_rate"], 1.0)
+
+    def test_candidates_require_chat_model(self):
+        llm = ScriptedChatModel(respond=lambda messages: '{"a": 2, "b": 7}') | StrOutputParser()
+        with self.assertRaises(ValueError):
+            LLMWithParsingRetry(llm=llm, parser=PydanticOutputParser(pydantic_object=Dot), candidates=2)
+
+
+PROSE = "Sure! Let me think about where the dot should be placed. " * 20
+
+
+class TestRetryingLLMStreaming(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.llm = ScriptedChatModel(
+            respond=lambda messages: PROSE if len(self.llm.calls) == 1 else '```json\n{"a": 2, "b": 7}\n```')
+
+    async def test_rejected_stream_is_stopped_early(self):
+        retrying_llm = LLMWithParsingRetry(
+            llm=self.llm, parser=PydanticOutputParser(pydantic_object=Dot), stream_validator=JsonStreamValidator)
+        self.assertEqual(await retrying_llm.ainvoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(self.llm.streamed_chunks[0], 1)
+        self.assertIn("Expected a JSON object or list", self.llm.calls[1][-1].content)
+
+    def test_sync_invoke(self):
+        retrying_llm = LLMWithParsingRetry(
+            llm=self.llm, parser=PydanticOutputParser(pydantic_object=Dot), stream_validator=JsonStreamValidator)
+        self.assertEqual(retrying_llm.invoke("dot"), Dot(a=2, b=7))
+        self.assertEqual(self.llm.streamed_chunks[0], 1)
+
+    async def test_astream_passes_first_attempt_through(self):
+        llm = ScriptedChatModel(respond=lambda messages: '{"a": 2, "b": 7}')
+        retrying_llm = LLMWithParsingRetry(llm=llm, parser=JsonOutputParser(), stream_validator=JsonStreamValidator)
+        outputs = [output async for output in retrying_llm.astream("dot")]
+        self.assertGreater(len(outputs), 1)
+        self.assertEqual(outputs[-1], {"a": 2, "b": 7})
+        self.assertEqual(len(llm.calls), 1)
+
+    async def test_astream_retries(self):
+        retrying_llm = LLMWithParsingRetry(
+            llm=self.llm, parser=JsonOutputParser(), stream_validator=JsonStreamValidator)
+        outputs = [output async for output in retrying_llm.astream("dot")]
+        self.assertEqual(outputs[-1], {"a": 2, "b": 7})
+        self.assertEqual(self.llm.streamed_chunks[0], 1)
+
+    def test_stream_does_not_repeat_delta_outputs(self):
+        llm = ScriptedChatModel(respond=lambda messages: "hello world")
+        retrying_llm = LLMWithParsingRetry(llm=llm, parser=StrOutputParser())
+        self.assertEqual(list(retrying_llm.stream("x")), list((llm | StrOutputParser()).stream("x")))
+        self.assertEqual(list(retrying_llm.stream("x")), ["hell", "o wo", "rld"])
+
+    async def test_astream_does_not_repeat_delta_outputs(self):
+        llm = ScriptedChatModel(respond=lambda messages: "hello world")
+        retrying_llm = LLMWithParsingRetry(llm=llm, parser=StrOutputParser())
+        self.assertEqual([output async for output in retrying_llm.astream("x")], ["hell", "o wo", "rld"])
+
+    async def test_stream_yields_repaired_output(self):
+        llm = ScriptedChatModel(respond=lambda messages: '{"a": 2, "b": 7,}')
+        for parser in [PydanticOutputParser(pydantic_object=Dot), JsonOutputParser()]:
+            with self.subTest(parser=type(parser).__name__):
+                retrying_llm = LLMWithParsingRetry(llm=llm, parser=parser, repairer=OutputRepairer())
+                expected = retrying_llm.invoke("dot")
+                self.assertEqual(list(retrying_llm.stream("dot"))[-1], expected)
+                self.assertEqual([output async for output in retrying_llm.astream("dot")][-1], expected)
+        self.assertEqual(len(llm.calls), 6)
+
+    def test_stream_without_validator(self):
+        retrying_llm = LLMWithParsingRetry(llm=self.llm, parser=PydanticOutputParser(pydantic_object=Dot))
+        outputs = list(retrying_llm.stream("dot"))
+        self.assertEqual(outputs[-1], Dot(a=2, b=7))
+        self.assertEqual(self.llm.streamed_chunks[0], len(PROSE) // self.llm.chunk_size)
+
+    async def test_exhausted(self):
+        llm = ScriptedChatModel(respond=lambda messages: PROSE)
+        retrying_llm = LLMWithParsingRetry(llm=llm, parser=JsonOutputParser(), stream_validator=JsonStreamValidator)
+        with self.assertRaises(OutputParserException):
+            [output async for output in retrying_llm.astream("dot")]
+        self.assertEqual(llm.streamed_chunks, [1, 1])
@@ -0,0 +1,34 @@
+import unittest
+
+from yid_langchain_extensions.llm.stream_validation import JsonStreamValidator
+
+
+def validate(*chunks: str) -> JsonStreamValidator:
+    validator = JsonStreamValidator()
+    for chunk in chunks:
+        if not validator.feed(chunk):
+            break
+    return validator
+
+
+class TestJsonStreamValidator(unittest.TestCase):
+    def test_accepts_json(self):
+        for chunks in [
+            ['  {"a": [1, {"b": "}]"}]', "}"],
+            ["```json\n", '[{"a": "\\"]"}]', "\n```"],
+            ["``", "`\n{", '"a": 1'],
+            ['{"a": 1} and some words after it'],
+        ]:
+            with self.subTest(chunks=chunks):
+                self.assertIsNone(validate(*chunks).error)
+
+    def test_rejects_prose(self):
+        validator = validate("  ", "Sure! Here ", "is the json: {}")
+        self.assertEqual(validator.error, "Expected a JSON object or list, got 'S' (at position 2 of the output)")
+        self.assertFalse(validator.feed("{}"))
+
+    def test_rejects_mismatched_brackets(self):
+        self.assertIn("Mismatched ']'", validate('{"a": 1]').error)
+
+    def test_rejects_broken_fence(self):
+        self.assertIn("Broken code fence", validate("``json").error)
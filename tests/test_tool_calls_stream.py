@@ -0,0 +1,88 @@
+import itertools
+import unittest
+
+from yid_langchain_extensions.llm.tool_calls_stream import ThinkSplitter, ToolCallsJsonScanner, ToolCallsStream
+
+R1_OUTPUT = (
+    '<think>\nI will call add.\n</think>\n```json\n'
+    '[{"name": "add", "arguments": {"a": 2, "b": "x}\\"]"}}, {"arguments": {"c": [1, {"d": null}]}, "name": "mul"}]'
+    '\n```'
+)
+
+
+def split(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream_message(text: str, size: int):
+    ids = itertools.count()
+    stream = ToolCallsStream(lambda: f"call_{next(ids)}")
+    messages = [message for message in map(stream.feed, split(text, size)) if message is not None]
+    last, error = stream.finish()
+    message = sum(messages, last)
+    return message, error
+
+
+class TestThinkSplitter(unittest.TestCase):
+    def test_split_by_chunks(self):
+        for size in (1, 3, 100):
+            splitter = ThinkSplitter()
+            parts = [splitter.feed(chunk) for chunk in split("  <think>hmm</thi</think>answer", size)]
+            parts.append(splitter.finish())
+            self.assertEqual("".join(thoughts for thoughts, _ in parts), "hmm</thi", size)
+            self.assertEqual("".join(output for _, output in parts), "answer", size)
+
+    def test_without_thoughts(self):
+        splitter = ThinkSplitter()
+        self.assertEqual(splitter.feed("<th"), ("", ""))
+        self.assertEqual(splitter.feed("e answer"), ("", "<the answer"))
+
+
+class TestToolCallsJsonScanner(unittest.TestCase):
+    def test_arguments_stream_as_they_arrive(self):
+        scanner = ToolCallsJsonScanner(lambda: "call_0")
+        self.assertEqual(scanner.feed('{"name": "ad'), [
+            {"name": None, "args": None, "id": "call_0", "index": 0, "type": "tool_call_chunk"}])
+        self.assertEqual(scanner.feed('d", "arguments": {"a": '), [
+            {"name": "add", "args": '{"a": ', "id": None, "index": 0, "type": "tool_call_chunk"}])
+        self.assertEqual(scanner.feed('2}} trailing'), [
+            {"name": None, "args": "2}", "id": None, "index": 0, "type": "tool_call_chunk"}])
+        self.assertTrue(scanner.done)
+        self.assertIsNone(scanner.check())
+
+    def test_errors(self):
+        for text, error in [
+            ('{"name": "add", "arguments": {"a": 2]}', "Mismatched ']'"),
+            ('{"name": "add", "arguments": {"a": 2}', "not complete"),
+            ('{"name": "add"}', "'arguments'"),
+            ('[{"arguments": {}}]', "'name'"),
+            ('{"name": "add", "arguments": {"a": 2,}}', "Invalid arguments json"),
+        ]:
+            with self.subTest(text=text):
+                scanner = ToolCallsJsonScanner(lambda: "call_0")
+                scanner.feed(text)
+                self.assertIn(error, scanner.check())
+
+
+class TestToolCallsStream(unittest.TestCase):
+    def test_chunks_sum_up_to_parsed_message(self):
+        for size in (1, 2, 7, 1000):
+            message, error = stream_message(R1_OUTPUT, size)
+            self.assertIsNone(error)
+            self.assertEqual(message.additional_kwargs, {"thoughts": "I will call add."})
+            self.assertEqual(message.content, "")
+            self.assertEqual(message.tool_calls, [
+                {"name": "add", "args": {"a": 2, "b": 'x}"]'}, "id": "call_0", "type": "tool_call"},
+                {"name": "mul", "args": {"c": [1, {"d": None}]}, "id": "call_1", "type": "tool_call"},
+            ])
+
+    def test_plain_text_answer(self):
+        message, error = stream_message("<think> hm </think>\n Hello,  world \n", 2)
+        self.assertEqual(message.content, "Hello,  world")
+        self.assertEqual(message.additional_kwargs, {"thoughts": "hm"})
+        self.assertEqual(error, "Output is not a tool calls json")
+
+    def test_unfinished_thoughts(self):
+        message, error = stream_message("<think>still thinking", 3)
+        self.assertEqual(message.additional_kwargs, {"thoughts": "still thinking"})
+        self.assertEqual(error, "Output is not a tool calls json")
@@ -0,0 +1,91 @@
+import json
+import unittest
+from typing import Dict, List, Literal, Optional
+
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import BaseModel, Field
+
+from yid_langchain_extensions.llm.tool_renderers import (
+    render_repr, render_json, render_stripped, render_typescript, TOOL_RENDERERS)
+
+
+class Attendee(BaseModel):
+    """An attendee"""
+    email: str = Field(description="email address")
+    optional: bool = False
+
+
+class Event(BaseModel):
+    """Creates an event"""
+    title: str
+    attendees: List[Attendee]
+    unit: Literal["c", "f"] = "c"
+    note: Optional[str] = None
+
+
+EVENT_TOOL = convert_to_openai_tool(Event, strict=True)
+
+
+class TestToolRenderers(unittest.TestCase):
+    def test_json_renderers_are_valid_json(self):
+        for renderer in (render_json, render_stripped):
+            with self.subTest(renderer=renderer.__name__):
+                self.assertEqual(json.loads(renderer(EVENT_TOOL))["name"], "Event")
+
+    def test_stripped(self):
+        function = json.loads(render_stripped(EVENT_TOOL))
+        self.assertNotIn("strict", function)
+        self.assertNotIn("additionalProperties", function["parameters"])
+        self.assertEqual(function["parameters"]["properties"]["note"], {"type": "string"})
+        self.assertEqual(
+            function["parameters"]["properties"]["unit"], {"default": "c", "enum": ["c", "f"], "type": "string"})
+
+    def test_stripped_keeps_properties_named_title(self):
+        properties = {"title": {"type": "string"}}
+        tool = {"name": "f", "parameters": {"title": "F", "type": "object", "properties": properties}}
+        self.assertEqual(json.loads(render_stripped(tool))["parameters"], {"type": "object", "properties": properties})
+
+    def test_dict_schemas_are_kept(self):
+        class Inventory(BaseModel):
+            """Updates stock"""
+            counts: Dict[str, int]
+            owners: Dict[str, Attendee] = {}
+
+        tool = convert_to_openai_tool(Inventory)
+        properties = json.loads(render_stripped(tool))["parameters"]["properties"]
+        self.assertEqual(properties["counts"], {"additionalProperties": {"type": "integer"}, "type": "object"})
+        typescript = render_typescript(tool)
+        self.assertIn("counts: Record<string, number /* integer */>,", typescript)
+        self.assertIn("owners?: Record<string, {email: string /* email address */, ", typescript)
+
+    def test_typescript(self):
+        self.assertEqual(render_typescript(EVENT_TOOL), "\n".join([
+            "// Creates an event",
+            "type Event = (_: {",
+            "title: string,",
+            "attendees: {email: string /* email address */, optional?: boolean /* default: false */}[],",
+            'unit?: "c" | "f", // default: "c"',
+            "note?: string,",
+            "}) => any;",
+        ]))
+
+    def test_typescript_keeps_integers(self):
+        class Schedule(BaseModel):
+            """Schedules a job"""
+            days: List[int]
+            retries: Optional[int] = None
+            ratio: float = 0.5
+
+        self.assertEqual(render_typescript(convert_to_openai_tool(Schedule)), "\n".join([
+            "// Schedules a job",
+            "type Schedule = (_: {",
+            "days: (number /* integer */)[],",
+            "retries?: number /* integer */,",
+            "ratio?: number, // default: 0.5",
+            "}) => any;",
+        ]))
+
+    def test_renderers_are_shorter_than_repr(self):
+        for name, renderer in TOOL_RENDERERS.items():
+            with self.subTest(renderer=name):
+                self.assertLessEqual(len(renderer(EVENT_TOOL)), len(render_repr(EVENT_TOOL)))
@@ -0,0 +1,45 @@
+import unittest
+
+from langchain_core.tools import tool
+from pydantic import BaseModel
+
+from yid_langchain_extensions.llm.tools_cache import LRUCache, OpenAIToolsCache, tool_key
+
+
+@tool
+def add(a: int, b: int) -> int:
+    """Adds a and b"""
+    return a + b
+
+
+class Dot(BaseModel):
+    """A dot"""
+    x: int
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.get_or_create("a", lambda: 1)
+        cache.get_or_create("b", lambda: 2)
+        self.assertEqual(cache.get_or_create("a", lambda: 10), 1)
+        cache.get_or_create("c", lambda: 3)
+        self.assertEqual(cache.get_or_create("b", lambda: 20), 20)
+        self.assertEqual(cache.get_or_create("c", lambda: 30), 3)
+        self.assertEqual(cache.stats(), {"size": 2, "maxsize": 2, "hits": 2, "misses": 4, "hit_rate": 1 / 3})
+
+
+class TestOpenAIToolsCache(unittest.TestCase):
+    def test_converts_once(self):
+        cache = OpenAIToolsCache()
+        converted = cache.convert(add)
+        self.assertIs(cache.convert(add), converted)
+        self.assertEqual(converted["function"]["name"], "add")
+        self.assertIsNot(cache.convert(add, strict=True), converted)
+        self.assertIs(cache.convert(Dot), cache.convert(Dot))
+        self.assertEqual(cache.cache.stats()["misses"], 3)
+
+    def test_dict_tools_are_keyed_by_schema(self):
+        schema = {"type": "function", "function": {"name": "f", "parameters": {"type": "object", "properties": {}}}}
+        self.assertEqual(tool_key(schema), tool_key({**schema}))
+        self.assertNotEqual(tool_key(schema), tool_key({**schema, "function": {"name": "g"}}))
@@ -1,11 +1,16 @@
+import threading
 import unittest
 
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage, HumanMessage, AIMessageChunk
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel
 
+from tests.fake_chat_model import ScriptedChatModel
+from yid_langchain_extensions.llm.output_repair import OutputRepairer
+from yid_langchain_extensions.llm.tool_renderers import render_typescript
 from yid_langchain_extensions.llm.tools_in_prompt_llm import (
     DeepseekR1JsonToolCallsParser, ModelWithPromptIntroducedTools)
 
@@ -179,3 +184,119 @@ class TestModelWithTools(unittest.TestCase):
         self.assertGreater(len(answer.tool_calls), 0)
         for tool_call in answer.tool_calls:
             self.assertEqual(tool_call["name"], "add")
+
+
+class TestDeepseekR1JsonToolCallsParserRepair(unittest.TestCase):
+    def test_repairs_example_like_output(self):
+        text = """<think>calling add</think>
+```json
+[
+    {
+        "name": "add",
+        "arguments": {
+            "a": 2,
+            "b": 3,
+        }
+    },
+]
+```"""
+        self.assertIn("parsing_error", DeepseekR1JsonToolCallsParser().invoke(text).additional_kwargs)
+        repairer = OutputRepairer()
+        answer = DeepseekR1JsonToolCallsParser(repairer=repairer, raise_if_cannot_parse=True).invoke(text)
+        self.assertEqual([(call["name"], call["args"]) for call in answer.tool_calls], [("add", {"a": 2, "b": 3})])
+        self.assertEqual(answer.additional_kwargs["thoughts"], "calling add")
+        self.assertEqual(repairer.stats()["repaired"], 1)
+
+    def test_repairs_streamed_output(self):
+        text = '<think>calling add</think>\n```json\n[{"name": "add", "arguments": {"a": 2, "b": 3,}},]\n```'
+        chunks = [text[i:i + 4] for i in range(0, len(text), 4)]
+        with self.assertRaises(OutputParserException):
+            list(DeepseekR1JsonToolCallsParser(raise_if_cannot_parse=True).transform(iter(chunks)))
+
+        parser = DeepseekR1JsonToolCallsParser(repairer=OutputRepairer(), raise_if_cannot_parse=True)
+        messages = list(parser.transform(iter(chunks)))
+        self.assertFalse(any(message.tool_call_chunks for message in messages[:-1]))
+        message = sum(messages[1:], messages[0])
+        self.assertEqual([(call["name"], call["args"]) for call in message.tool_calls], [("add", {"a": 2, "b": 3})])
+        self.assertEqual(message.additional_kwargs, {"thoughts": "calling add"})
+
+    def test_stream_with_repairer_keeps_valid_tool_calls(self):
+        text = '{"name": "add", "arguments": {"a": 2, "b": 3}}'
+        parser = DeepseekR1JsonToolCallsParser(repairer=OutputRepairer())
+        messages = list(parser.transform(iter([text[:10], text[10:]])))
+        self.assertEqual([(call["name"], call["args"]) for call in messages[-1].tool_calls],
+                         [("add", {"a": 2, "b": 3})])
+        self.assertEqual(parser.repairer.stats()["repaired"], 0)
+        with self.assertRaises(OutputParserException):
+            list(DeepseekR1JsonToolCallsParser(repairer=OutputRepairer(), raise_if_cannot_parse=True).transform(
+                iter(["no tool calls here"])))
+
+
+class TestDeepseekR1JsonToolCallsParserStreaming(unittest.IsolatedAsyncioTestCase):
+    text = '<think>calling add</think>\n```json\n{"name": "add", "arguments": {"a": 2, "b": 3}}\n```'
+
+    async def test_astream_yields_tool_call_chunks(self):
+        async def chunks():
+            for i in range(0, len(self.text), 4):
+                yield AIMessageChunk(content=self.text[i:i + 4])
+
+        messages = [message async for message in DeepseekR1JsonToolCallsParser().atransform(chunks())]
+        self.assertTrue(all(isinstance(message, AIMessageChunk) for message in messages))
+        self.assertGreater(sum(bool(message.tool_call_chunks) for message in messages), 2)
+        message = sum(messages[1:], messages[0])
+        self.assertEqual([(call["name"], call["args"]) for call in message.tool_calls], [("add", {"a": 2, "b": 3})])
+        self.assertEqual(message.additional_kwargs, {"thoughts": "calling add"})
+
+    def test_stream_parsing_error(self):
+        chunks = ["<think>hm</think>", "Hello"]
+        last = list(DeepseekR1JsonToolCallsParser().transform(iter(chunks)))[-1]
+        self.assertEqual(last.additional_kwargs["parsing_error"], "Output is not a tool calls json")
+        with self.assertRaises(OutputParserException):
+            list(DeepseekR1JsonToolCallsParser(raise_if_cannot_parse=True).transform(iter(chunks)))
+
+
+class TestModelWithPromptIntroducedToolsDelegation(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.threads = []
+
+        def respond(messages):
+            self.threads.append(threading.get_ident())
+            return "Hello there, how are you?"
+
+        self.model = ModelWithPromptIntroducedTools.wrap_model(ScriptedChatModel(respond=respond))
+
+    async def test_ainvoke_stays_on_event_loop(self):
+        self.assertEqual((await self.model.ainvoke("hi")).content, "Hello there, how are you?")
+        self.assertEqual(self.threads, [threading.get_ident()])
+
+    async def test_astream_yields_base_model_chunks(self):
+        chunks = [chunk.content async for chunk in self.model.astream("hi")]
+        self.assertEqual(chunks, ["Hell", "o th", "ere,", " how", " are", " you", "?"])
+        self.assertEqual(self.threads, [threading.get_ident()])
+
+    def test_stream_yields_base_model_chunks(self):
+        self.assertEqual(len(list(self.model.stream("hi"))), 7)
+
+    def test_bind_tools_is_cached(self):
+        ModelWithPromptIntroducedTools.compiled_tools_cache.clear()
+        first = self.model.bind_tools([add, Dot], tool_choice="any")
+        second = self.model.bind_tools([add, Dot], tool_choice="any")
+        self.assertIs(first.first, second.first)
+        parallel = self.model.bind_tools([add, Dot], tool_choice="any", parallel_tool_calls=True)
+        self.assertIsNot(parallel.first, first.first)
+        other_model = ModelWithPromptIntroducedTools.wrap_model(self.model.base_model)
+        self.assertIs(other_model.bind_tools([add, Dot], tool_choice="any").last, other_model)
+        self.assertEqual(len(ModelWithPromptIntroducedTools.compiled_tools_cache), 2)
+        self.assertIs(self.model.bind_tools([add], tool_choice="none"), self.model)
+        self.model.bind_tools([add], tool_choice="add").invoke("hi")
+        self.assertIn("tool 'add'", self.model.base_model.calls[-1][-1].content)
+
+    def test_tool_renderer(self):
+        model = ModelWithPromptIntroducedTools.wrap_model(self.model.base_model, tool_renderer=render_typescript)
+        model.bind_tools([add], tool_choice="add").invoke("hi")
+        self.assertIn("type add = (_: {", self.model.base_model.calls[-1][-1].content)
+        self.assertIsNot(model.bind_tools([add]).first, self.model.bind_tools([add]).first)
+
+    def test_streaming_disabled_on_base_model(self):
+        self.model.base_model.disable_streaming = True
+        self.assertEqual([chunk.content for chunk in self.model.stream("hi")], ["Hello there, how are you?"])
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from typing import Dict, Any, Union, Deque, Tuple
+
+# rough estimate of a high detail image in prompt tokens, the real value depends on image size
+IMAGE_PROMPT_TOKENS = 765
+MESSAGE_OVERHEAD_TOKENS = 4
+CHARS_PER_TOKEN = 4
+
+
+def estimate_prompt_tokens(body: Dict[str, Any]) -> int:
+    """
+    Cheap upper-bound-ish estimate of prompt tokens of a chat completions (or embeddings) request body.
+    Text is counted as CHARS_PER_TOKEN characters per token, images as IMAGE_PROMPT_TOKENS each.
+    """
+    chars = 0
+    tokens = 0
+    inputs = body.get("input", [])
+    for item in [inputs] if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)) else inputs:
+        if isinstance(item, str):
+            chars += len(item)
+        else:
+            tokens += len(item)  # already tokenized input
+    for message in body.get("messages", []):
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    chars += len(part.get("text", ""))
+                elif part.get("type") in ("image_url", "input_audio"):
+                    tokens += IMAGE_PROMPT_TOKENS
+        if message.get("tool_calls"):
+            chars += len(json.dumps(message["tool_calls"]))
+    for key in ("tools", "functions", "response_format"):
+        if body.get(key):
+            chars += len(json.dumps(body[key]))
+    return tokens + math.ceil(chars / CHARS_PER_TOKEN)
+
+
+class EnqueuedTokensLimiter:
+    """
+    Keeps estimated prompt tokens enqueued in batches of each model under the organization limit.
+    Batches not fitting into the limit wait in a local FIFO queue until running batches finish.
+    A batch is always admitted if nothing of its model is enqueued, even if it is bigger than the limit.
+    """
+
+    def __init__(self, max_enqueued_tokens: Union[int, Dict[str, int]]):
+        self.max_enqueued_tokens = max_enqueued_tokens
+        self.enqueued_tokens: Dict[str, int] = {}
+        self.total_wait_time = 0.0
+        self.admitted_batches = 0
+        self._queues: Dict[str, Deque[Tuple[int, float, asyncio.Future]]] = {}
+
+    def _limit(self, model: str) -> float:
+        if isinstance(self.max_enqueued_tokens, dict):
+            return self.max_enqueued_tokens.get(model, math.inf)
+        return self.max_enqueued_tokens
+
+    def _fits(self, model: str, tokens: int) -> bool:
+        enqueued = self.enqueued_tokens.get(model, 0)
+        return enqueued == 0 or enqueued + tokens <= self._limit(model)
+
+    def _admit(self, model: str, tokens: int, queued_at: float):
+        self.enqueued_tokens[model] = self.enqueued_tokens.get(model, 0) + tokens
+        self.total_wait_time += time.monotonic() - queued_at
+        self.admitted_batches += 1
+
+    async def acquire(self, model: str, tokens: int):
+        queue = self._queues.setdefault(model, deque())
+        queued_at = time.monotonic()
+        if not queue and self._fits(model, tokens):
+            self._admit(model, tokens, queued_at)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (tokens, queued_at, waiter)
+        queue.append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                self.release(model, tokens)  # admitted right before cancellation
+            elif entry in queue:
+                queue.remove(entry)
+                self.release(model, 0)  # next batch in the queue might fit now
+            raise
+
+    def release(self, model: str, tokens: int):
+        self.enqueued_tokens[model] = max(0, self.enqueued_tokens.get(model, 0) - tokens)
+        queue = self._queues.get(model)
+        while queue and (queue[0][2].done() or self._fits(model, queue[0][0])):
+            tokens, queued_at, waiter = queue.popleft()
+            if not waiter.done():
+                self._admit(model, tokens, queued_at)
+                waiter.set_result(None)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        oldest = [queue[0][1] for queue in self._queues.values() if queue]
+        return {
+            "enqueued_tokens": dict(self.enqueued_tokens),
+            "queue_depth": self.queue_depth,
+            "longest_current_wait": now - min(oldest) if oldest else 0.0,
+            "admitted_batches": self.admitted_batches,
+            "average_wait_time": self.total_wait_time / self.admitted_batches if self.admitted_batches else 0.0,
+        }
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Iterable, Tuple, List, Any, Callable
+
+
+class BatchesResponseCache:
+    """
+    Persistent content-addressed cache of raw ChatCompletion JSONs for BatchesOpenAICompletions.
+    Keys are hashes of the normalized request body (which includes the model).
+    Entries expire after ttl seconds, and least recently used entries are evicted
+     when the total size of stored responses exceeds max_size_bytes.
+    Backed by SQLite in WAL mode, so the same directory can be shared by several processes.
+    The total size is kept up to date by triggers, so eviction runs only once the limit is exceeded.
+    Reads run on the calling thread and never wait for writers (WAL). Writes, which may wait up to 60 seconds
+     for other processes, run on a dedicated writer thread: get() only schedules its access time update,
+     put()/put_many() block until written, aput_many() awaits the write without blocking the event loop.
+    """
+
+    def __init__(self, directory: str, ttl: Optional[float] = None, max_size_bytes: int = 1024 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size_bytes = max_size_bytes
+        path = os.path.join(directory, "responses.sqlite")
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # used only on the writer thread
+        self._write_connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batches-cache-writer")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_by_access ON responses (accessed_at)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._connection.execute(
+                "INSERT OR IGNORE INTO meta (name, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM responses")
+            self._connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_inserted AFTER INSERT ON responses BEGIN "
+                "UPDATE meta SET value = value + NEW.size WHERE name = 'total_size'; END"
+            )
+            self._connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_updated AFTER UPDATE OF size ON responses BEGIN "
+                "UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_size'; END"
+            )
+            self._connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_deleted AFTER DELETE ON responses BEGIN "
+                "UPDATE meta SET value = value - OLD.size WHERE name = 'total_size'; END"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        row = self._connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        if self.ttl is not None and created_at + self.ttl < now:
+            self._write(self._delete, key)
+            return None
+        self._write(self._touch, key, now)
+        return response
+
+    def put(self, key: str, response: str):
+        self.put_many([(key, response)])
+
+    def put_many(self, items: Iterable[Tuple[str, str]]):
+        """Stores (key, response) pairs in a single transaction."""
+        self._write(self._put_rows, self._rows(items)).result()
+
+    async def aput_many(self, items: Iterable[Tuple[str, str]]):
+        await asyncio.wrap_future(self._write(self._put_rows, self._rows(items)))
+
+    def total_size(self) -> int:
+        return self._total_size(self._connection)
+
+    @staticmethod
+    def _total_size(connection: sqlite3.Connection) -> int:
+        total_size, = connection.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()
+        return total_size
+
+    def _write(self, function: Callable[..., None], *args: Any) -> Future:
+        return self._writer.submit(function, *args)
+
+    def _rows(self, items: Iterable[Tuple[str, str]]) -> List[Tuple[str, str, int, float, float]]:
+        now = time.time()
+        rows = []
+        for key, response in items:
+            size = len(response.encode())
+            if size <= self.max_size_bytes:
+                rows.append((key, response, size, now, now))
+        return rows
+
+    def _delete(self, key: str):
+        with self._write_connection:
+            self._write_connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _touch(self, key: str, accessed_at: float):
+        with self._write_connection:
+            self._write_connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (accessed_at, key))
+
+    def _put_rows(self, rows: List[Tuple[str, str, int, float, float]]):
+        if not rows:
+            return
+        with self._write_connection:
+            # upsert instead of INSERT OR REPLACE: replaced rows do not fire delete triggers
+            self._write_connection.executemany(
+                "INSERT INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, "
+                "created_at = excluded.created_at, accessed_at = excluded.accessed_at", rows
+            )
+            if self._total_size(self._write_connection) > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._write_connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        total_size = self._total_size(self._write_connection)
+        to_delete = []
+        for key, size in self._write_connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if total_size <= self.max_size_bytes:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self._write_connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._write_connection.close()
+        self._connection.close()
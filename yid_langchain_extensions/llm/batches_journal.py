@@ -0,0 +1,96 @@
+import sqlite3
+from typing import Optional, List, Set, Iterable, Tuple, NamedTuple
+
+
+class JournalEntry(NamedTuple):
+    custom_id: str
+    batch_id: str
+    result: Optional[str]
+
+
+class BatchesJournal:
+    """
+    SQLite journal of requests submitted through BatchesOpenAICompletions.
+    For each request it keeps custom_id, hash of the request body, input file id, batch id,
+     index of the pool client owning the batch
+     and (once the batch finished but nobody is waiting for it yet) the raw result line.
+    It lets a restarted process re-attach to its pending batches
+     and resolve re-issued identical requests from the original job instead of launching new ones.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "custom_id TEXT PRIMARY KEY, request_hash TEXT NOT NULL, "
+                "input_file_id TEXT, batch_id TEXT, result TEXT, client_index INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [column[1] for column in self._connection.execute("PRAGMA table_info(requests)")]
+            if "client_index" not in columns:  # journal created before pool mode was added
+                self._connection.execute("ALTER TABLE requests ADD COLUMN client_index INTEGER NOT NULL DEFAULT 0")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS requests_by_hash ON requests (request_hash)")
+        # entries this process already waits for (submitted by it or claimed by re-issued requests)
+        self._claimed: Set[str] = set()
+
+    def record_upload(self, requests: Iterable[Tuple[str, str]], input_file_id: str, client_index: int = 0):
+        """Records (custom_id, request_hash) pairs uploaded within input_file_id by client_index pool client."""
+        requests = list(requests)
+        self._claimed.update(custom_id for custom_id, _ in requests)
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO requests (custom_id, request_hash, input_file_id, client_index) "
+                "VALUES (?, ?, ?, ?)",
+                [(custom_id, request_hash, input_file_id, client_index) for custom_id, request_hash in requests]
+            )
+
+    def record_launch(self, input_file_id: str, batch_id: str):
+        with self._connection:
+            self._connection.execute(
+                "UPDATE requests SET batch_id = ? WHERE input_file_id = ?", (batch_id, input_file_id))
+
+    def discard_unlaunched(self):
+        """Forgets requests whose batch was never created (process died between upload and launch)."""
+        with self._connection:
+            self._connection.execute("DELETE FROM requests WHERE batch_id IS NULL")
+
+    def pending_batch_ids(self) -> List[str]:
+        rows = self._connection.execute(
+            "SELECT DISTINCT batch_id FROM requests WHERE batch_id IS NOT NULL AND result IS NULL")
+        return [batch_id for batch_id, in rows]
+
+    def client_index(self, batch_id: str) -> int:
+        row = self._connection.execute("SELECT client_index FROM requests WHERE batch_id = ?", (batch_id,)).fetchone()
+        return row[0] if row else 0
+
+    def custom_ids(self, batch_id: str) -> List[str]:
+        rows = self._connection.execute(
+            "SELECT custom_id FROM requests WHERE batch_id = ? AND result IS NULL", (batch_id,))
+        return [custom_id for custom_id, in rows]
+
+    def claim(self, request_hash: str) -> Optional[JournalEntry]:
+        """Finds a launched request with the same body not yet claimed by this process."""
+        rows = self._connection.execute(
+            "SELECT custom_id, batch_id, result FROM requests WHERE request_hash = ? AND batch_id IS NOT NULL",
+            (request_hash,)
+        )
+        for custom_id, batch_id, result in rows:
+            if custom_id not in self._claimed:
+                self._claimed.add(custom_id)
+                return JournalEntry(custom_id, batch_id, result)
+        return None
+
+    def store_result(self, custom_id: str, result: str):
+        with self._connection:
+            self._connection.execute("UPDATE requests SET result = ? WHERE custom_id = ?", (result, custom_id))
+
+    def remove(self, custom_ids: Iterable[str]):
+        custom_ids = list(custom_ids)
+        self._claimed.difference_update(custom_ids)
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM requests WHERE custom_id = ?", [(custom_id,) for custom_id in custom_ids])
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import re
+from typing import Any, Iterator, IO, Iterable
+
+STREAMED_STRING_CHUNK = 64 * 1024
+# printable ASCII except '"' and '\', such strings (e.g. base64 data urls of images) need no JSON escaping
+_JSON_SAFE_STRING = re.compile(r'[\x20\x21\x23-\x5b\x5d-\x7e]*')
+
+
+def iter_json_chunks(obj: Any, sort_keys: bool = False) -> Iterator[str]:
+    """
+    Compact JSON encoding of obj as a stream of ASCII chunks.
+    Long strings which need no escaping (inline base64 images) are yielded in slices,
+     so the encoded document (or a copy of such string) is never built in memory as a whole.
+    """
+    if isinstance(obj, str):
+        if len(obj) > STREAMED_STRING_CHUNK and _JSON_SAFE_STRING.fullmatch(obj):
+            yield '"'
+            for start in range(0, len(obj), STREAMED_STRING_CHUNK):
+                yield obj[start:start + STREAMED_STRING_CHUNK]
+            yield '"'
+        else:
+            yield json.dumps(obj)
+    elif isinstance(obj, dict):
+        yield "{"
+        items = sorted(obj.items()) if sort_keys else obj.items()
+        for i, (key, value) in enumerate(items):
+            yield ("," if i else "") + json.dumps(str(key)) + ":"
+            yield from iter_json_chunks(value, sort_keys)
+        yield "}"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, item in enumerate(obj):
+            if i:
+                yield ","
+            yield from iter_json_chunks(item, sort_keys)
+        yield "]"
+    else:
+        yield json.dumps(obj, separators=(",", ":"), sort_keys=sort_keys)
+
+
+def json_size(obj: Any) -> int:
+    """Size in bytes of the JSON encoding of obj, computed without building it."""
+    return sum(len(chunk) for chunk in iter_json_chunks(obj))
+
+
+def json_hash(obj: Any) -> str:
+    """sha256 of the canonical (sorted keys) JSON encoding of obj."""
+    hasher = hashlib.sha256()
+    for chunk in iter_json_chunks(obj, sort_keys=True):
+        hasher.update(chunk.encode())
+    return hasher.hexdigest()
+
+
+def write_jsonl(objects: Iterable[Any], stream: IO[bytes]):
+    for obj in objects:
+        for chunk in iter_json_chunks(obj):
+            stream.write(chunk.encode())
+        stream.write(b"\n")
@@ -0,0 +1,57 @@
+import time
+from typing import Optional, Dict, Any
+
+from openai.types import Batch
+
+
+class BatchMetrics:
+    """
+    Lifecycle record of one batch launched (or re-attached) by BatchesOpenAICompletions,
+     passed to its metrics_hook once results of the batch are collected.
+    timestamps maps phases to the time (time.time()) they were first observed, in order:
+     window_opened, launched, admitted, uploaded, batch statuses seen while polling
+     (validating, in_progress, finalizing, completed / failed / expired / cancelled), downloaded and cleaned_up.
+    A status never seen between two polls is attributed to the previous phase.
+    """
+
+    def __init__(self, model: Optional[str], requests: int, client_index: int = 0):
+        self.batch_id: Optional[str] = None
+        self.model = model
+        self.client_index = client_index
+        self.requests = requests
+        self.status: Optional[str] = None
+        self.timestamps: Dict[str, float] = {}
+        self.polls = 0
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.completed_requests = 0
+        self.failed_requests = 0
+        self.retried_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def mark(self, phase: str, at: Optional[float] = None):
+        self.timestamps.setdefault(phase, time.time() if at is None else at)
+
+    def observe(self, batch: Batch):
+        """Records a batch status seen by the poller."""
+        self.polls += 1
+        self.status = batch.status
+        self.mark(batch.status)
+
+    def record_line(self, result_line: Dict[str, Any], size: int, succeeded: bool, retried: bool):
+        self.bytes_downloaded += size
+        if retried:
+            self.retried_requests += 1
+        elif succeeded:
+            self.completed_requests += 1
+        else:
+            self.failed_requests += 1
+        usage = ((result_line.get("response") or {}).get("body") or {}).get("usage") or {}
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+
+    def durations(self) -> Dict[str, float]:
+        """Seconds spent in each phase, until the next observed one."""
+        phases = sorted(self.timestamps.items(), key=lambda item: item[1])
+        return {phase: next_at - at for (phase, at), (_, next_at) in zip(phases, phases[1:])}
@@ -1,23 +1,297 @@
 import asyncio
+import functools
+import io
 import json
+import logging
+import random
 import tempfile
+import time
 import uuid
-from typing import Iterable, Union, Optional, Dict, List
+from typing import Iterable, Union, Optional, Dict, List, Set, Any, Coroutine, AsyncIterator, Callable, Tuple, IO, \
+    Sequence
 
 import httpx
-from openai import NotGiven, NOT_GIVEN, AsyncOpenAI
+from openai import NotGiven, NOT_GIVEN, AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
 from openai._types import Headers, Query, Body
 from openai._utils import maybe_transform, required_args
 from openai.resources.chat import AsyncCompletions
-from openai.types import ChatModel
+from openai.types import ChatModel, Batch
 from openai.types.chat import ChatCompletionMessageParam, completion_create_params, ChatCompletionStreamOptionsParam, \
     ChatCompletionToolChoiceOptionParam, ChatCompletionToolParam, ChatCompletion
 from typing_extensions import Literal
 
+from yid_langchain_extensions.llm.batches_admission import EnqueuedTokensLimiter, estimate_prompt_tokens
+from yid_langchain_extensions.llm.batches_cache import BatchesResponseCache
+from yid_langchain_extensions.llm.batches_journal import BatchesJournal
+from yid_langchain_extensions.llm.batches_metrics import BatchMetrics
+from yid_langchain_extensions.llm.batches_jsonl import json_hash, json_size, write_jsonl
+
+logger = logging.getLogger(__name__)
+
+BATCH_BUSY_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+DEFAULT_POLL_INTERVALS = {
+    "validating": 2,
+    "in_progress": 30,
+    "finalizing": 2,
+    "cancelling": 5,
+}
+
+# line errors worth resubmitting in a follow-up batch
+RETRYABLE_LINE_STATUS_CODES = {408, 409, 429}
+RETRYABLE_LINE_ERROR_CODES = {"batch_expired", "rate_limit_exceeded", "server_error"}
+# successful responses of an output file are written to the cache in transactions of this many lines
+CACHE_WRITE_LINES = 1000
+# upper bound of the exponential backoff of polls failed with transient errors, seconds
+MAX_POLL_BACKOFF = 600
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Errors of the OpenAI API worth retrying later: rate limits, connection problems and server errors."""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def backoff_delay(interval: float, failures: int, jitter: float) -> float:
+    """Exponential backoff after the given number of consecutive transient failures, capped at MAX_POLL_BACKOFF."""
+    if failures:
+        interval = min(interval * 2 ** failures, max(MAX_POLL_BACKOFF, interval))
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+class BatchRequestError(Exception):
+    """Error of a single request inside a batch."""
+
+    def __init__(self, message: Any, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _PendingBatch:
+    def __init__(self):
+        self.requests: List[Dict[str, Any]] = []
+        self.size = 0
+        self.custom_ids: List[str] = []
+        self.request_hashes: List[str] = []
+        self.custom_id_by_hash: Dict[str, str] = {}
+        # requests of the window cancelled by all their callers, dropped when the window is flushed
+        self.abandoned: Set[str] = set()
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+        self.opened_at = time.time()
+        self.metrics: Optional[BatchMetrics] = None
+        # pool client the batch is launched on, and estimated tokens acquired from its admission control
+        self.owner = 0
+        self.launched = False
+        self.prompt_tokens = 0
+
+    def fits(self, request_size: int, max_lines: int, max_bytes: int) -> bool:
+        return len(self.requests) < max_lines and self.size + request_size + 1 <= max_bytes
+
+    def subset(self, custom_ids: Set[str]) -> "_PendingBatch":
+        pending = _PendingBatch()
+        pending.opened_at = self.opened_at
+        for custom_id, request_hash, request in zip(self.custom_ids, self.request_hashes, self.requests):
+            if custom_id in custom_ids:
+                pending.add(custom_id, request_hash, request, json_size(request))
+        return pending
+
+    @property
+    def model(self) -> str:
+        return self.requests[0]["body"]["model"]
+
+    def add(self, custom_id: str, request_hash: str, request: Dict[str, Any], request_size: int):
+        self.requests.append(request)
+        self.size += request_size + 1
+        self.custom_ids.append(custom_id)
+        self.request_hashes.append(request_hash)
+        self.custom_id_by_hash.setdefault(request_hash, custom_id)
+
+    def abandon(self, custom_id: str) -> bool:
+        """Marks a request of the window nobody waits for, returns whether the whole window is abandoned."""
+        self.abandoned.add(custom_id)
+        return len(self.abandoned) == len(self.custom_ids)
+
+
+class _WatchedBatch:
+    def __init__(
+            self, status: str, next_poll_at: float, waiter: asyncio.Future,
+            on_poll: Optional[Callable[[Batch], None]] = None
+    ):
+        self.status = status
+        self.next_poll_at = next_poll_at
+        self.waiter = waiter
+        self.on_poll = on_poll
+        self.failed_polls = 0
+
+
+class _BatchPoller:
+    """
+    Single background task polling all in-flight batches of one client.
+    Each batch is polled with an interval depending on its last seen status (plus relative jitter),
+     so the number of retrieve calls grows with the number of batches, not with the number of callers.
+    Polls failed with transient errors (see is_transient_error) are retried with exponential backoff,
+     only other errors (e.g. the batch is not found) fail the waiter.
+    """
+
+    def __init__(self, client: AsyncOpenAI, intervals: Dict[str, float], jitter: float):
+        self.client = client
+        self.intervals = intervals
+        self.jitter = jitter
+        self.loop = asyncio.get_running_loop()
+        self._watched: Dict[str, _WatchedBatch] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _next_poll_at(self, status: str, failed_polls: int = 0) -> float:
+        interval = self.intervals.get(status, max(self.intervals.values()))
+        return time.monotonic() + backoff_delay(interval, failed_polls, self.jitter)
+
+    def watch(self, batch: Batch, on_poll: Optional[Callable[[Batch], None]] = None) -> asyncio.Future:
+        """
+        Returns a future resolved with the final Batch object once the batch leaves busy statuses.
+        on_poll is called with every retrieved state of the batch.
+        """
+        watched = self._watched.get(batch.id)
+        if watched is None:
+            waiter = self.loop.create_future()
+            watched = _WatchedBatch(batch.status, self._next_poll_at(batch.status), waiter, on_poll)
+            self._watched[batch.id] = watched
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+        return watched.waiter
+
+    async def _poll(self, batch_id: str, watched: _WatchedBatch):
+        try:
+            batch = await self.client.batches.retrieve(batch_id)
+        except Exception as e:
+            if is_transient_error(e):
+                watched.failed_polls += 1
+                watched.next_poll_at = self._next_poll_at(watched.status, watched.failed_polls)
+                return
+            del self._watched[batch_id]
+            if not watched.waiter.done():
+                watched.waiter.set_exception(e)
+            return
+        watched.failed_polls = 0
+        if watched.on_poll is not None:
+            watched.on_poll(batch)
+        if batch.status in BATCH_BUSY_STATUSES:
+            watched.status = batch.status
+            watched.next_poll_at = self._next_poll_at(batch.status)
+            return
+        del self._watched[batch_id]
+        if not watched.waiter.done():
+            watched.waiter.set_result(batch)
+
+    async def _run(self):
+        while self._watched:
+            next_poll_at = min(watched.next_poll_at for watched in self._watched.values())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_poll_at - time.monotonic()))
+                continue  # new batch registered, recompute the nearest poll time
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            due = [(batch_id, watched) for batch_id, watched in self._watched.items() if watched.next_poll_at <= now]
+            await asyncio.gather(*(self._poll(batch_id, watched) for batch_id, watched in due))
+
+
+class _PoolMember:
+    def __init__(self, client: AsyncOpenAI, weight: float, admission: Optional[EnqueuedTokensLimiter]):
+        self.client = client
+        self.weight = weight
+        self.admission = admission
+        self.poller: Optional[_BatchPoller] = None
+        self.enqueued_lines = 0
+
 
 class BatchesOpenAICompletions(AsyncCompletions):
-    def __init__(self, client: AsyncOpenAI | None = None):
-        super().__init__(client=client or AsyncOpenAI())
+    """
+    Chat completions client that runs every request through the OpenAI Batch API.
+    By default each create() call is sent as its own batch.
+    If batch_window is set, concurrent create() calls are coalesced for batch_window seconds
+     (or until max_batch_lines/max_batch_bytes is reached) and sent as one multi-line batch.
+    All in-flight batches are tracked by one shared poller using per-status poll_intervals.
+    If journal is set, submitted requests are recorded there, so after a restart
+     re-issued identical requests are resolved from the original batches.
+    If deduplicate is set, byte-identical request bodies are submitted only once per batch
+     and all their callers get the same result (only makes sense for deterministic requests).
+    If cache is set, successful responses are stored there and identical requests are answered
+     from it without any upload or polling.
+    Requests failed with retryable errors (rate limits, server errors, expiration) are resubmitted
+     in follow-up batches up to max_line_retries times, other failures fail only their own callers.
+    If max_enqueued_tokens is set (for all models or per model), batches wait in a local queue
+     while their estimated prompt tokens do not fit into the organization's enqueued tokens limit,
+     see admission_stats() for queue depth and waiting time.
+    If client is a list of clients (e.g. with keys of different organizations), batches are spread
+     over them by weighted least-loaded scheduling (see client_weights) and polling, downloads and cleanup
+     are routed to the client owning each batch. Enqueued tokens limit applies to each client separately.
+     With a journal, keep the order of clients the same between restarts.
+    Once every request of a running batch is cancelled by its callers (e.g. on timeout), the batch is cancelled too,
+     unless a journal is used (a restarted process may still claim its results).
+    If metrics_hook is set, it receives BatchMetrics (phase timestamps, request counts, bytes, token usage)
+     of every batch once its results are collected; errors of the hook are logged and otherwise ignored.
+    """
+
+    endpoint = "/v1/chat/completions"
+
+    def __init__(
+            self, client: Union[AsyncOpenAI, Sequence[AsyncOpenAI], None] = None,
+            batch_window: Optional[float] = None,
+            max_batch_lines: int = 50_000,
+            max_batch_bytes: int = 200 * 1024 * 1024,
+            poll_intervals: Optional[Dict[str, float]] = None,
+            poll_jitter: float = 0.2,
+            journal: Optional[BatchesJournal] = None,
+            upload_spool_size: int = 64 * 1024 * 1024,
+            deduplicate: bool = False,
+            cache: Optional[BatchesResponseCache] = None,
+            max_line_retries: int = 2,
+            max_enqueued_tokens: Union[int, Dict[str, int], None] = None,
+            token_estimator: Callable[[Dict[str, Any]], int] = estimate_prompt_tokens,
+            client_weights: Optional[Sequence[float]] = None,
+            metrics_hook: Optional[Callable[[BatchMetrics], None]] = None,
+    ):
+        clients = [client] if isinstance(client, AsyncOpenAI) else list(client or [AsyncOpenAI()])
+        client_weights = list(client_weights) if client_weights is not None else [1.0] * len(clients)
+        if len(client_weights) != len(clients):
+            raise ValueError(f"Got {len(client_weights)} client_weights for {len(clients)} clients")
+        if any(weight <= 0 for weight in client_weights):
+            raise ValueError(f"client_weights must be positive, got {client_weights}")
+        super().__init__(client=clients[0])
+        self.batch_window = batch_window
+        self.max_batch_lines = max_batch_lines
+        self.max_batch_bytes = max_batch_bytes
+        self.poll_intervals = poll_intervals or DEFAULT_POLL_INTERVALS
+        self.poll_jitter = poll_jitter
+        self.journal = journal
+        self.upload_spool_size = upload_spool_size
+        self.deduplicate = deduplicate
+        self.cache = cache
+        self.max_line_retries = max_line_retries
+        self.token_estimator = token_estimator
+        self.metrics_hook = metrics_hook
+        self.pool = [
+            _PoolMember(
+                pool_client, weight,
+                EnqueuedTokensLimiter(max_enqueued_tokens) if max_enqueued_tokens is not None else None
+            )
+            for pool_client, weight in zip(clients, client_weights)
+        ]
+        self._journal_reattached = False
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._request_hashes: Dict[str, str] = {}
+        # request body and enqueue function of requests claimed from the journal, by custom_id
+        self._claimed_requests: Dict[str, Tuple[Dict[str, Any], Callable[[str, Dict[str, Any]], str]]] = {}
+        self._pending: Dict[str, _PendingBatch] = {}
+        # model of the batch window of each request not launched yet
+        self._pending_lines: Dict[str, str] = {}
+        self._running_batches: Set[asyncio.Task] = set()
+        # launched batches by custom_id, and custom_ids of each launched batch somebody still waits for
+        self._line_batches: Dict[str, Tuple[int, str]] = {}
+        self._batch_waited_lines: Dict[str, Set[str]] = {}
 
     def filter_not_given(self, params: Dict[str, str]) -> Dict[str, str]:
         return {key: value for key, value in params.items() if value != NOT_GIVEN}
@@ -54,7 +328,6 @@ class BatchesOpenAICompletions(AsyncCompletions):
         extra_body: Body | None = None,
         timeout: float | httpx.Timeout | None | NotGiven = NOT_GIVEN,
     ) -> ChatCompletion:
-        job_id = str(uuid.uuid4())
         body = maybe_transform(
             {
                 "messages": messages,
@@ -82,58 +355,488 @@ class BatchesOpenAICompletions(AsyncCompletions):
             },
             completion_create_params.CompletionCreateParams,
         )
+        return await self._submit(self.filter_not_given(body), self._enqueue)
+
+    def _request_body(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Batch line body for a dict of create() arguments."""
+        body = maybe_transform({**params, "stream": False}, completion_create_params.CompletionCreateParams)
+        return self.filter_not_given(body)
+
+    def _parse_response(self, body: Dict[str, Any]) -> Any:
+        return ChatCompletion(**body)
+
+    async def submit_many(
+            self, requests: Iterable[Dict[str, Any]]
+    ) -> AsyncIterator[Tuple[int, Union[Any, Exception]]]:
+        """
+        Bulk entry point for offline jobs.
+        Each request is a dict of create() arguments (messages, model, temperature, ...).
+        Requests are split into shards limited by max_batch_lines/max_batch_bytes, all shards are launched
+         concurrently and (index, response or exception) pairs are yielded as soon as results arrive.
+        """
+        finished: asyncio.Queue = asyncio.Queue()
+        shards: Dict[str, _PendingBatch] = {}
+
+        def add_to_shard(request_hash: str, request_body: Dict[str, Any]) -> str:
+            shard = shards.setdefault(request_body["model"], _PendingBatch())
+            if self.deduplicate and request_hash in shard.custom_id_by_hash:
+                return shard.custom_id_by_hash[request_hash]
+            request, request_size = self._build_request(request_body)
+            if shard.requests and not shard.fits(request_size, self.max_batch_lines, self.max_batch_bytes):
+                self._launch(shard)
+                shard = shards[request_body["model"]] = _PendingBatch()
+            shard.add(request["custom_id"], request_hash, request, request_size)
+            return request["custom_id"]
+
+        num_requests = 0
+        for index, params in enumerate(requests):
+            waiter = self._submit(self._request_body(params), add_to_shard)
+            waiter.add_done_callback(lambda done_waiter, index=index: finished.put_nowait((index, done_waiter)))
+            num_requests += 1
+        for shard in shards.values():
+            if shard.requests:
+                self._launch(shard)
+
+        for _ in range(num_requests):
+            index, done_waiter = await finished.get()
+            yield index, done_waiter.exception() or done_waiter.result()
+
+    def _submit(self, request_body: Dict[str, Any], enqueue: Callable[[str, Dict[str, Any]], str]) -> asyncio.Future:
+        request_hash = json_hash(request_body)
+        waiter = asyncio.get_running_loop().create_future()
+        if self.cache is not None:
+            cached_response = self.cache.get(request_hash)
+            if cached_response is not None:
+                waiter.set_result(self._parse_response(json.loads(cached_response)))
+                return waiter
+        if self.journal is not None:
+            self._reattach_journal()
+            entry = self.journal.claim(request_hash)
+            if entry is not None:
+                # identical request was already submitted before restart, waiting for the original job
+                self._add_waiter(entry.custom_id, request_hash, waiter)
+                if entry.result is not None:
+                    self._resolve_line(entry.result)
+                else:
+                    # kept to resubmit the request if the original batch turns out to be gone
+                    self._claimed_requests[entry.custom_id] = (request_body, enqueue)
+                return waiter
+        self._add_waiter(enqueue(request_hash, request_body), request_hash, waiter)
+        return waiter
+
+    def _add_waiter(self, custom_id: str, request_hash: str, waiter: asyncio.Future):
+        self._waiters.setdefault(custom_id, []).append(waiter)
+        self._request_hashes[custom_id] = request_hash
+        waiter.add_done_callback(functools.partial(self._abandon, custom_id))
+
+    def _abandon(self, custom_id: str, waiter: asyncio.Future):
+        """Forgets a cancelled waiter, cancelling its batch once nobody waits for any of the batch requests."""
+        waiters = self._waiters.get(custom_id)
+        if not waiter.cancelled() or self.journal is not None or waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if waiters:
+            return
+        del self._waiters[custom_id]
+        self._request_hashes.pop(custom_id, None)
+        if custom_id in self._pending_lines:
+            self._abandon_pending(custom_id)
+            return
+        owner, batch_id = self._line_batches.pop(custom_id, (0, None))
+        waited_lines = self._batch_waited_lines.get(batch_id)
+        if waited_lines is None:
+            return
+        waited_lines.discard(custom_id)
+        if not waited_lines:
+            del self._batch_waited_lines[batch_id]
+            task = asyncio.get_running_loop().create_task(self._cancel_batch(owner, batch_id))
+            self._running_batches.add(task)
+            task.add_done_callback(self._running_batches.discard)
+
+    def _abandon_pending(self, custom_id: str):
+        """Drops a cancelled request still in its batch window, and the window once all its requests are dropped."""
+        model = self._pending_lines.pop(custom_id)
+        pending = self._pending[model]
+        if pending.abandon(custom_id):
+            del self._pending[model]
+            if pending.flush_timer is not None:
+                pending.flush_timer.cancel()
+
+    async def _cancel_batch(self, owner: int, batch_id: str):
+        try:
+            await self.pool[owner].client.batches.cancel(batch_id)
+        except Exception:
+            pass  # batch has finished meanwhile, its results will be dropped
+
+    def _build_request(self, request_body: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
         request = {
-            "body": self.filter_not_given(body),
-            "custom_id": job_id,
+            "body": request_body,
+            "custom_id": str(uuid.uuid4()),
             "method": "POST",
-            "url": "/v1/chat/completions",
+            "url": self.endpoint,
         }
-        with tempfile.NamedTemporaryFile(suffix=".jsonl", mode="w") as input_file:
-            # writing to input file
-            input_file.write(json.dumps(request))
-            input_file.flush()
-
-            # uploading input file
-            with open(input_file.name, "rb") as f:
-                batch_input_file = await self._client.files.create(
-                    file=f,
-                    purpose="batch"
-                )
+        return request, json_size(request)
 
-        # launching
-        batch_launch_info = await self._client.batches.create(
-            input_file_id=batch_input_file.id,
-            endpoint="/v1/chat/completions",
-            completion_window="24h",
-            metadata={"description": job_id}
-        )
+    def _enqueue(self, request_hash: str, request_body: Dict[str, Any]) -> str:
+        # batch input file may contain requests to only one model, so each model has its own window
+        model = request_body["model"]
+        pending = self._pending.get(model)
+        if self.deduplicate and pending is not None and request_hash in pending.custom_id_by_hash:
+            # identical request is already waiting in this batch window, sharing its result
+            custom_id = pending.custom_id_by_hash[request_hash]
+            if custom_id in pending.abandoned:
+                pending.abandoned.discard(custom_id)
+                self._pending_lines[custom_id] = model
+            return custom_id
+        request, request_size = self._build_request(request_body)
+        if pending is not None and not pending.fits(request_size, self.max_batch_lines, self.max_batch_bytes):
+            self._flush(model)
+            pending = None
+        if pending is None:
+            pending = self._pending[model] = _PendingBatch()
+            if self.batch_window is not None:
+                pending.flush_timer = asyncio.get_running_loop().call_later(self.batch_window, self._flush, model)
+        pending.add(request["custom_id"], request_hash, request, request_size)
+        self._pending_lines[request["custom_id"]] = model
+        if self.batch_window is None or len(pending.requests) >= self.max_batch_lines:
+            self._flush(model)
+        return request["custom_id"]
 
-        # waiting to finish
+    def _flush(self, model: str):
+        pending = self._pending.pop(model, None)
+        if pending is not None:
+            if pending.flush_timer is not None:
+                pending.flush_timer.cancel()
+            for custom_id in pending.custom_ids:
+                self._pending_lines.pop(custom_id, None)
+            if pending.abandoned:
+                pending = pending.subset(set(pending.custom_ids) - pending.abandoned)
+            self._launch(pending)
+
+    def _launch(self, pending: _PendingBatch):
+        self._run_in_background(self._run_batch(pending), pending.custom_ids)
+
+    def _run_in_background(self, coroutine: Coroutine, custom_ids: List[str]):
+        async def run():
+            try:
+                await coroutine
+            except Exception as e:
+                self._fail(custom_ids, e)
+            self._fail(custom_ids, Exception("LLM failed with unknown reason"))
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._running_batches.add(task)
+        task.add_done_callback(self._running_batches.discard)
+
+    def _fail(self, custom_ids: Iterable[str], error: Exception):
+        for custom_id in custom_ids:
+            self._request_hashes.pop(custom_id, None)
+            self._claimed_requests.pop(custom_id, None)
+            for waiter in self._waiters.pop(custom_id, []):
+                if not waiter.done():
+                    waiter.set_exception(error)
+
+    def _reattach_journal(self):
+        if self._journal_reattached:
+            return
+        self._journal_reattached = True
+        self.journal.discard_unlaunched()
+        for batch_id in self.journal.pending_batch_ids():
+            self._run_in_background(self._reattach_batch(batch_id), self.journal.custom_ids(batch_id))
+
+    async def _reattach_batch(self, batch_id: str):
+        """
+        Waits for a batch launched before restart. Transient errors are retried with backoff for as long as it takes,
+         since nothing else would ever watch the batch whose requests may still be claimed.
+        """
+        owner = self.journal.client_index(batch_id)
+        failures = 0
         while True:
-            await asyncio.sleep(5)
-            batch_updated_info = await self._client.batches.retrieve(batch_launch_info.id)
-            if batch_updated_info.status in ["validating", "in_progress", "finalizing", "cancelling"]:
-                continue  # still busy
-            elif batch_updated_info.status == "completed" and batch_updated_info.output_file_id:  # done
-                # getting result
-                result_content = await self._client.files.content(batch_updated_info.output_file_id)
-                # parsing result
-                json_string = result_content.content.decode(result_content.encoding)
-                data_dict = json.loads(json_string)
-                completion = ChatCompletion(**data_dict["response"]["body"])
-
-                # cleanup files
-                await self._client.files.delete(batch_input_file.id)
-                await self._client.files.delete(batch_updated_info.output_file_id)
-
-                return completion
-            else:  # batch failed
-                await self._client.files.delete(batch_input_file.id)
-                if batch_updated_info.error_file_id:
-                    result_content = await self._client.files.content(batch_updated_info.error_file_id)
-                    json_string = result_content.content.decode(result_content.encoding)
-                    data_dict = json.loads(json_string)
-                    await self._client.files.delete(batch_updated_info.error_file_id)
-                    raise Exception(data_dict["response"]["body"])
+            try:
+                batch = await self.pool[owner].client.batches.retrieve(batch_id)
+                await self._finish_batch(owner, batch, self.journal.custom_ids(batch_id))
+                return
+            except Exception as e:
+                if not is_transient_error(e):
+                    break
+            failures += 1
+            await asyncio.sleep(backoff_delay(min(self.poll_intervals.values()), failures, self.poll_jitter))
+        # the batch or its files are gone (purged, another API key, ...), so it is forgotten for good
+        # and requests claimed from it are submitted anew
+        custom_ids = self.journal.custom_ids(batch_id)
+        self.journal.remove(custom_ids)
+        self._resubmit_claimed(custom_ids)
+
+    def _resubmit_claimed(self, custom_ids: Iterable[str]):
+        for custom_id in custom_ids:
+            claimed = self._claimed_requests.pop(custom_id, None)
+            waiters = [waiter for waiter in self._waiters.pop(custom_id, []) if not waiter.done()]
+            request_hash = self._request_hashes.pop(custom_id, None)
+            if claimed is None or not waiters:
+                continue
+            request_body, enqueue = claimed
+            new_custom_id = enqueue(request_hash, request_body)
+            for waiter in waiters:
+                self._add_waiter(new_custom_id, request_hash, waiter)
+
+    def admission_stats(self) -> List[Dict[str, Any]]:
+        """Admission control stats (queue depth, waiting time, ...) for each pool client."""
+        return [member.admission.stats() for member in self.pool if member.admission is not None]
+
+    def _watch(self, owner: int, batch: Batch, metrics: BatchMetrics) -> asyncio.Future:
+        member = self.pool[owner]
+        if member.poller is None or member.poller.loop is not asyncio.get_running_loop():
+            member.poller = _BatchPoller(member.client, self.poll_intervals, self.poll_jitter)
+        return member.poller.watch(batch, metrics.observe)
+
+    @staticmethod
+    async def _iter_lines(client: AsyncOpenAI, file_id: str) -> AsyncIterator[str]:
+        """Streams a JSONL file line by line, so results never have to be held in memory all at once."""
+        async with client.files.with_streaming_response.content(file_id) as result_content:
+            async for line in result_content.iter_lines():
+                if line.strip():
+                    yield line
+
+    @staticmethod
+    def _is_success(result_line: Dict[str, Any]) -> bool:
+        response = result_line.get("response") or {}
+        return not result_line.get("error") and response.get("status_code") == 200
+
+    @staticmethod
+    def _is_retryable(result_line: Dict[str, Any]) -> bool:
+        error = result_line.get("error") or {}
+        if error.get("code") in RETRYABLE_LINE_ERROR_CODES:
+            return True
+        status_code = (result_line.get("response") or {}).get("status_code")
+        return status_code is not None and (status_code in RETRYABLE_LINE_STATUS_CODES or status_code >= 500)
+
+    def _resolve(self, waiter: asyncio.Future, result_line: Dict[str, Any]):
+        if waiter.done():
+            return
+        if self._is_success(result_line):
+            waiter.set_result(self._parse_response(result_line["response"]["body"]))
+        else:
+            response = result_line.get("response") or {}
+            waiter.set_exception(BatchRequestError(
+                result_line.get("error") or response.get("body"), status_code=response.get("status_code")))
+
+    def _resolve_line(
+            self, raw_line: str, result_line: Optional[Dict[str, Any]] = None,
+            cached: Optional[List[Tuple[str, str]]] = None
+    ) -> str:
+        """Resolves waiters of the line; responses to cache are appended to cached if given, or stored at once."""
+        result_line = result_line or json.loads(raw_line)
+        custom_id = result_line["custom_id"]
+        waiters = self._waiters.pop(custom_id, [])
+        for waiter in waiters:
+            self._resolve(waiter, result_line)
+        request_hash = self._request_hashes.pop(custom_id, None)
+        self._claimed_requests.pop(custom_id, None)
+        if self.cache is not None and request_hash is not None and self._is_success(result_line):
+            response = (request_hash, json.dumps(result_line["response"]["body"]))
+            if cached is not None:
+                cached.append(response)
+            else:
+                self.cache.put(*response)
+        if waiters:
+            if self.journal is not None:
+                self.journal.remove([custom_id])
+        elif self.journal is not None:
+            # re-attached batch finished before the request was re-issued, keeping result for later
+            self.journal.store_result(custom_id, raw_line)
+        return custom_id
+
+    def _write_input_file(self, pending: _PendingBatch) -> IO[bytes]:
+        """
+        Serializes batch requests to an in-memory buffer chunk by chunk (without building JSON strings),
+         only batches bigger than upload_spool_size are spilled to an anonymous temporary file.
+        """
+        input_file = io.BytesIO() if pending.size <= self.upload_spool_size else tempfile.TemporaryFile()
+        write_jsonl(pending.requests, input_file)
+        input_file.seek(0)
+        return input_file
+
+    async def _run_batch(self, pending: _PendingBatch):
+        batch = await self._launch_batch(pending)
+        await self._finish_batch(pending.owner, batch, pending.custom_ids, pending)
+
+    def _pick_owner(self) -> int:
+        """Weighted least-loaded scheduling over the pool: the fewest enqueued lines per unit of weight."""
+        return min(range(len(self.pool)), key=lambda i: self.pool[i].enqueued_lines / self.pool[i].weight)
+
+    async def _launch_batch(self, pending: _PendingBatch) -> Batch:
+        pending.owner = self._pick_owner()
+        metrics = pending.metrics = BatchMetrics(pending.model, len(pending.requests), pending.owner)
+        metrics.mark("window_opened", pending.opened_at)
+        metrics.mark("launched")
+        member = self.pool[pending.owner]
+        member.enqueued_lines += len(pending.requests)
+        pending.launched = True
+        try:
+            if member.admission is not None:
+                pending.prompt_tokens = sum(self.token_estimator(request["body"]) for request in pending.requests)
+                await member.admission.acquire(pending.model, pending.prompt_tokens)
+            metrics.mark("admitted")
+            return await self._upload_and_create_batch(pending)
+        except BaseException:
+            self._release(pending)
+            raise
+
+    def _release(self, pending: _PendingBatch):
+        """Returns lines and estimated tokens of a finished batch to its pool client."""
+        if not pending.launched:
+            return
+        pending.launched = False
+        member = self.pool[pending.owner]
+        member.enqueued_lines -= len(pending.requests)
+        if member.admission is not None and pending.prompt_tokens:
+            member.admission.release(pending.model, pending.prompt_tokens)
+            pending.prompt_tokens = 0
+
+    async def _upload_and_create_batch(self, pending: _PendingBatch) -> Batch:
+        client = self.pool[pending.owner].client
+        batch_description = str(uuid.uuid4())
+        # uploading input file
+        with self._write_input_file(pending) as input_file:
+            batch_input_file = await client.files.create(
+                file=("batch_input.jsonl", input_file),
+                purpose="batch"
+            )
+        pending.metrics.bytes_uploaded = pending.size
+        pending.metrics.mark("uploaded")
+        if self.journal is not None:
+            self.journal.record_upload(
+                zip(pending.custom_ids, pending.request_hashes), batch_input_file.id, client_index=pending.owner)
+
+        # launching
+        try:
+            batch_launch_info = await client.batches.create(
+                input_file_id=batch_input_file.id,
+                endpoint=self.endpoint,
+                completion_window="24h",
+                metadata={"description": batch_description}
+            )
+        except Exception:
+            await client.files.delete(batch_input_file.id)
+            if self.journal is not None:
+                self.journal.remove(pending.custom_ids)
+            raise
+        if self.journal is not None:
+            self.journal.record_launch(batch_input_file.id, batch_launch_info.id)
+        pending.metrics.batch_id = batch_launch_info.id
+        pending.metrics.status = batch_launch_info.status
+        pending.metrics.mark(batch_launch_info.status)
+        return batch_launch_info
+
+    async def _finish_batch(
+            self, owner: int, batch: Batch, custom_ids: List[str], pending: Optional[_PendingBatch] = None
+    ):
+        """
+        Waits for the batch and routes its results.
+        Lines failed with retryable errors are resubmitted as a follow-up batch (up to max_line_retries times),
+         so a handful of failures does not re-run the whole batch.
+        """
+        for attempt in range(self.max_line_retries + 1):
+            client = self.pool[owner].client
+            if pending is not None:
+                metrics = pending.metrics
+            else:
+                metrics = BatchMetrics(None, len(custom_ids), owner)
+                metrics.batch_id = batch.id
+                metrics.mark("reattached")
+            waited_lines = self._batch_waited_lines[batch.id] = {
+                custom_id for custom_id in custom_ids if custom_id in self._waiters}
+            self._line_batches.update((custom_id, (owner, batch.id)) for custom_id in waited_lines)
+            try:
+                retry_ids = await self._collect_batch(
+                    owner, batch, custom_ids, metrics, can_retry=attempt < self.max_line_retries)
+            finally:
+                self._batch_waited_lines.pop(batch.id, None)
+                for custom_id in waited_lines:
+                    self._line_batches.pop(custom_id, None)
+                if pending is not None:
+                    self._release(pending)
+                self._report_metrics(metrics)
+            if retry_ids:
+                if pending is None:  # re-attached batch, requests are known only from its input file
+                    pending = await self._read_input_file(client, batch.input_file_id, retry_ids)
                 else:
-                    raise Exception("LLM failed with unknown reason")
+                    pending = pending.subset(retry_ids)
+            await client.files.delete(batch.input_file_id)
+            if not retry_ids:
+                return
+            batch = await self._launch_batch(pending)
+            owner = pending.owner
+            custom_ids = pending.custom_ids
+
+    def _report_metrics(self, metrics: BatchMetrics):
+        if self.metrics_hook is None:
+            return
+        try:
+            self.metrics_hook(metrics)
+        except Exception:
+            logger.exception("Batch metrics hook failed for batch %s", metrics.batch_id)
+
+    async def _read_input_file(self, client: AsyncOpenAI, file_id: str, custom_ids: Set[str]) -> _PendingBatch:
+        pending = _PendingBatch()
+        async for raw_line in self._iter_lines(client, file_id):
+            request = json.loads(raw_line)
+            if request["custom_id"] in custom_ids:
+                pending.add(request["custom_id"], json_hash(request["body"]), request, len(raw_line.encode()))
+        return pending
+
+    async def _collect_batch(
+            self, owner: int, batch: Batch, custom_ids: List[str], metrics: BatchMetrics, can_retry: bool
+    ) -> Set[str]:
+        """Resolves waiters of finished lines and returns custom_ids of lines worth resubmitting."""
+        client = self.pool[owner].client
+        # waiting to finish
+        if batch.status in BATCH_BUSY_STATUSES:
+            batch = await self._watch(owner, batch, metrics)
+        else:
+            metrics.observe(batch)
+
+        # demultiplexing results by custom_id
+        unresolved = set(custom_ids)
+        retry_ids = set()
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                cached = []
+                async for raw_line in self._iter_lines(client, file_id):
+                    result_line = json.loads(raw_line)
+                    succeeded = self._is_success(result_line)
+                    retried = can_retry and not succeeded and self._is_retryable(result_line)
+                    metrics.record_line(result_line, len(raw_line.encode()) + 1, succeeded, retried)
+                    if retried:
+                        retry_ids.add(result_line["custom_id"])
+                        unresolved.discard(result_line["custom_id"])
+                    else:
+                        unresolved.discard(self._resolve_line(raw_line, result_line, cached))
+                    if len(cached) >= CACHE_WRITE_LINES:
+                        await self.cache.aput_many(cached)
+                        cached.clear()
+                if cached:
+                    await self.cache.aput_many(cached)
+        metrics.mark("downloaded")
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                await client.files.delete(file_id)
+        metrics.mark("cleaned_up")
+
+        if can_retry and batch.status == "expired":
+            # requests not processed within completion window are not reported in any file
+            return self._still_waited(retry_ids | unresolved)
+        if batch.errors and batch.errors.data:
+            batch_error = BatchRequestError(batch.errors.data[0].message)
+        else:
+            batch_error = BatchRequestError("LLM failed with unknown reason")
+        self._fail(unresolved, batch_error)
+        if self.journal is not None:
+            self.journal.remove(unresolved)
+        return self._still_waited(retry_ids)
+
+    def _still_waited(self, custom_ids: Set[str]) -> Set[str]:
+        """Drops abandoned requests, nobody would receive their results (with a journal, a restarted process may)."""
+        if self.journal is not None:
+            return custom_ids
+        return {custom_id for custom_id in custom_ids if custom_id in self._waiters}
@@ -0,0 +1,55 @@
+import base64
+from typing import Union, List, Iterable, Dict, Any
+
+import httpx
+import numpy as np
+from openai import NotGiven, NOT_GIVEN
+from openai._types import Headers, Query, Body
+from openai._utils import maybe_transform
+from openai.types import EmbeddingModel, embedding_create_params
+from typing_extensions import Literal
+
+from yid_langchain_extensions.llm.batches_openai_client import BatchesOpenAICompletions
+
+
+class BatchesOpenAIEmbeddings(BatchesOpenAICompletions):
+    """
+    Embeddings client that runs every request through the OpenAI Batch API (/v1/embeddings endpoint),
+     to be used as async_client of langchain_openai.OpenAIEmbeddings.
+    Windows, journal, cache, retries, admission control and client pools work as in BatchesOpenAICompletions.
+    Embeddings are requested base64-encoded (4 bytes per float in the downloaded results instead of ~20 chars)
+     and returned as float32 numpy arrays in a dict shaped as CreateEmbeddingResponse.
+    """
+
+    endpoint = "/v1/embeddings"
+
+    async def create(
+        self,
+        *,
+        input: Union[str, List[str], Iterable[int], Iterable[Iterable[int]]],
+        model: Union[str, EmbeddingModel],
+        dimensions: int | NotGiven = NOT_GIVEN,
+        encoding_format: Literal["float", "base64"] | NotGiven = NOT_GIVEN,
+        user: str | NotGiven = NOT_GIVEN,
+        # this params are ignored
+        extra_headers: Headers | None = None,
+        extra_query: Query | None = None,
+        extra_body: Body | None = None,
+        timeout: float | httpx.Timeout | None | NotGiven = NOT_GIVEN,
+    ) -> Dict[str, Any]:
+        body = self._request_body({"input": input, "model": model, "dimensions": dimensions, "user": user})
+        return await self._submit(body, self._enqueue)
+
+    def _request_body(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        body = maybe_transform({**params, "encoding_format": "base64"}, embedding_create_params.EmbeddingCreateParams)
+        return self.filter_not_given(body)
+
+    @staticmethod
+    def _decode_embedding(embedding: Union[str, List[float]]) -> np.ndarray:
+        if isinstance(embedding, str):
+            return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+        return np.asarray(embedding, dtype=np.float32)
+
+    def _parse_response(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        data = [{**item, "embedding": self._decode_embedding(item["embedding"])} for item in body["data"]]
+        return {**body, "data": data}
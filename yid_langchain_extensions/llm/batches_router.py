@@ -0,0 +1,97 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional, Dict, Any, Union
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from openai.resources.chat import AsyncCompletions
+from openai.types.chat import ChatCompletion
+
+from yid_langchain_extensions.llm.batches_openai_client import BatchesOpenAICompletions
+
+# RunnableConfig metadata keys read by the router
+DEADLINE_KEY = "deadline"
+PRIORITY_KEY = "priority"
+REALTIME_PRIORITY = "realtime"
+
+_routing: ContextVar[Optional[Dict[str, Any]]] = ContextVar("batches_routing", default=None)
+
+
+class RoutingMetadataHandler(AsyncCallbackHandler):
+    """
+    Makes deadline and priority from RunnableConfig metadata visible to BatchesRouterCompletions.
+    Runs inline at the start of each chat model call, so its metadata applies to the completions request
+     made by that very call.
+    """
+
+    run_inline: bool = True
+
+    async def on_chat_model_start(
+            self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID,
+            metadata: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> None:
+        metadata = metadata or {}
+        _routing.set({key: metadata[key] for key in (DEADLINE_KEY, PRIORITY_KEY) if key in metadata})
+
+
+class BatchesRouterCompletions(AsyncCompletions):
+    """
+    Routes chat completions between the Batch API (cheap, slow) and realtime completions by per-request deadline.
+    Deadline (unix timestamp or datetime) and priority come from RunnableConfig metadata
+     ({"deadline": ..., "priority": "realtime"}), pass router.callbacks to the ChatOpenAI to make them visible.
+    Requests with realtime priority, streaming requests and requests with less than min_batch_time seconds left
+     go to realtime completions right away. Others are sent to the batch client; if a batch result is not back
+     realtime_reserve seconds before the deadline, the request is abandoned (its batch is cancelled once nobody
+     waits for it) and repeated in realtime. Requests without a deadline use default_deadline seconds from now,
+     or wait for the batch however long it takes if it is None.
+    """
+
+    def __init__(
+            self, batches: BatchesOpenAICompletions,
+            realtime: Optional[AsyncCompletions] = None,
+            min_batch_time: float = 60 * 60,
+            realtime_reserve: float = 2 * 60,
+            default_deadline: Optional[float] = None,
+    ):
+        if realtime_reserve >= min_batch_time:
+            # otherwise requests sent to the batch client would have no time left for their batches
+            raise ValueError(
+                f"realtime_reserve ({realtime_reserve}) must be less than min_batch_time ({min_batch_time})")
+        super().__init__(client=batches._client)
+        self.batches = batches
+        self.realtime = realtime or batches._client.chat.completions
+        self.min_batch_time = min_batch_time
+        self.realtime_reserve = realtime_reserve
+        self.default_deadline = default_deadline
+        self.callbacks = [RoutingMetadataHandler()]
+        self.stats = {"realtime": 0, "batch": 0, "fallback": 0}
+
+    def _deadline(self, routing: Dict[str, Any]) -> Optional[float]:
+        deadline: Union[float, datetime, None] = routing.get(DEADLINE_KEY)
+        if isinstance(deadline, datetime):
+            return deadline.timestamp()
+        if deadline is None and self.default_deadline is not None:
+            return time.time() + self.default_deadline
+        return deadline
+
+    async def create(self, **kwargs: Any) -> ChatCompletion:
+        routing = _routing.get() or {}
+        deadline = self._deadline(routing)
+        time_left = deadline - time.time() if deadline is not None else None
+        if (
+                kwargs.get("stream") or routing.get(PRIORITY_KEY) == REALTIME_PRIORITY
+                or (time_left is not None and time_left < self.min_batch_time)
+        ):
+            self.stats["realtime"] += 1
+            return await self.realtime.create(**kwargs)
+
+        self.stats["batch"] += 1
+        if time_left is None:
+            return await self.batches.create(**kwargs)
+        try:
+            return await asyncio.wait_for(self.batches.create(**kwargs), time_left - self.realtime_reserve)
+        except asyncio.TimeoutError:
+            self.stats["fallback"] += 1
+            return await self.realtime.create(**kwargs)
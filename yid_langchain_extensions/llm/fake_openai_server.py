@@ -0,0 +1,264 @@
+import base64
+import json
+import random
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from typing import Dict, Any, Callable, List, Union, Sequence
+
+import httpx
+import numpy as np
+from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI
+
+from yid_langchain_extensions.llm.batches_openai_client import BatchesOpenAICompletions, BATCH_BUSY_STATUSES
+
+# the fake server completes batches at once, so there is no point in polling slower
+FAST_POLL_INTERVALS = dict.fromkeys(BATCH_BUSY_STATUSES, 0.01)
+
+
+def echo_completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    content = body["messages"][-1]["content"]
+    if not isinstance(content, str):
+        content = " ".join(part["text"] for part in content if part["type"] == "text")
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def fake_embedding(text: str, dimensions: int = 8) -> np.ndarray:
+    """Deterministic pseudo-embedding of a text."""
+    return np.random.default_rng(sum(text.encode())).standard_normal(dimensions).astype(np.float32)
+
+
+def embed_inputs(body: Dict[str, Any]) -> Dict[str, Any]:
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    data = []
+    for index, text in enumerate(inputs):
+        embedding = fake_embedding(text if isinstance(text, str) else " ".join(map(str, text)))
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(embedding.tobytes()).decode()
+        else:
+            embedding = embedding.tolist()
+        data.append({"object": "embedding", "index": index, "embedding": embedding})
+    return {"object": "list", "data": data, "model": body["model"],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}}
+
+
+def fake_batches_client(client: Union[AsyncOpenAI, Sequence[AsyncOpenAI]], **kwargs: Any) -> BatchesOpenAICompletions:
+    """BatchesOpenAICompletions polling with FAST_POLL_INTERVALS unless poll_intervals is given."""
+    kwargs.setdefault("poll_intervals", FAST_POLL_INTERVALS)
+    return BatchesOpenAICompletions(client, **kwargs)
+
+
+def fake_batches_llm(
+        client: Union[AsyncOpenAI, Sequence[AsyncOpenAI]], model_name: str = "gpt-4.1-nano", **kwargs: Any
+) -> ChatOpenAI:
+    """ChatOpenAI over fake_batches_client(client, **kwargs), the batches client is its async_client."""
+    return ChatOpenAI(
+        model_name=model_name, temperature=0, api_key="fake", async_client=fake_batches_client(client, **kwargs))
+
+
+class FakeLineError(Exception):
+    """Raised by a responder to fail a single batch line with given status code."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FakeOpenAIServer:
+    """
+    In-process stand-in for the OpenAI Files, Batches and (realtime) Chat Completions endpoints.
+    Batches are processed with `responder` (which may raise FakeLineError to fail a line) and reported
+     as completed after `retrieves_to_complete` retrieve calls and `validation_delay` + `processing_delay` seconds
+     (being "validating" for the first validation_delay seconds and "in_progress" after that).
+    Cancelled batches are reported as cancelled on the next retrieve, without any output.
+    File contents are streamed back in chunks of `chunk_size` bytes.
+    Failures are injected with given rates: any call may fail with HTTP 500 (`http_failure_rate`)
+     and a batch may fail validation as a whole (`batch_failure_rate`).
+    Status codes put into `retrieve_errors` are returned by the next batch retrieve calls, one per call.
+    """
+
+    def __init__(
+            self, responder: Callable[[Dict[str, Any]], Dict[str, Any]] = echo_completion,
+            retrieves_to_complete: int = 1, chunk_size: int = 100,
+            validation_delay: float = 0.0, processing_delay: float = 0.0,
+            http_failure_rate: float = 0.0, batch_failure_rate: float = 0.0, seed: int = 0,
+    ):
+        self.responder = responder
+        self.retrieves_to_complete = retrieves_to_complete
+        self.chunk_size = chunk_size
+        self.validation_delay = validation_delay
+        self.processing_delay = processing_delay
+        self.http_failure_rate = http_failure_rate
+        self.batch_failure_rate = batch_failure_rate
+        self._random = random.Random(seed)
+        self._created_at: Dict[str, float] = {}
+        self._failing_batches = set()
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.batch_requests: Dict[str, List[Dict[str, Any]]] = {}
+        self.calls: Dict[str, int] = {}
+        self.max_active_batches = 0
+        self.retrieve_errors: List[int] = []
+
+    def client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key="fake", base_url="http://fake-openai/v1", max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle)),
+        )
+
+    def batches_client(self, **kwargs: Any) -> BatchesOpenAICompletions:
+        return fake_batches_client(self.client(), **kwargs)
+
+    def batches_llm(self, model_name: str = "gpt-4.1-nano", **kwargs: Any) -> ChatOpenAI:
+        return fake_batches_llm(self.client(), model_name, **kwargs)
+
+    def _count(self, route: str):
+        self.calls[route] = self.calls.get(route, 0) + 1
+
+    def _store_file(self, content: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = content
+        return {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+
+    def _upload(self, request: httpx.Request) -> Dict[str, Any]:
+        header = f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode()
+        message = BytesParser(policy=default_policy).parsebytes(header + request.content)
+        fields, content, filename = {}, b"", "upload.jsonl"
+        for part in message.iter_parts():
+            if part.get_filename():
+                filename = part.get_filename()
+                content = part.get_payload(decode=True)
+            else:
+                fields[part.get_param("name", header="content-disposition")] = part.get_content().strip()
+        return self._store_file(content, filename, fields.get("purpose", "batch"))
+
+    def _create_batch(self, request: httpx.Request) -> Dict[str, Any]:
+        params = json.loads(request.content)
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": params["endpoint"],
+            "input_file_id": params["input_file_id"], "completion_window": params["completion_window"],
+            "created_at": int(time.time()), "status": "validating", "metadata": params.get("metadata"),
+        }
+        self.batches[batch["id"]] = batch
+        self._created_at[batch["id"]] = time.monotonic()
+        if self._random.random() < self.batch_failure_rate:
+            self._failing_batches.add(batch["id"])
+        active_batches = sum(batch["status"] in ("validating", "in_progress") for batch in self.batches.values())
+        self.max_active_batches = max(self.max_active_batches, active_batches)
+        self.batch_requests[batch["id"]] = [
+            json.loads(line) for line in self.files[batch["input_file_id"]].decode().splitlines() if line.strip()]
+        return batch
+
+    def _process(self, batch: Dict[str, Any]):
+        outputs, errors = [], []
+        for request in self.batch_requests[batch["id"]]:
+            try:
+                response = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                            "body": self.responder(request["body"])}
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                                "response": response, "error": None})
+            except Exception as e:
+                response = {"status_code": getattr(e, "status_code", 400), "request_id": uuid.uuid4().hex,
+                            "body": {"error": {"message": str(e), "type": "invalid_request_error"}}}
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                               "response": response, "error": None})
+        if outputs:
+            batch["output_file_id"] = self._store_file(
+                "".join(json.dumps(line) + "\n" for line in outputs).encode(), "output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self._store_file(
+                "".join(json.dumps(line) + "\n" for line in errors).encode(), "errors.jsonl", "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs),
+                                   "failed": len(errors)}
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    def _cancel_batch(self, batch_id: str) -> Dict[str, Any]:
+        batch = self.batches[batch_id]
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+        return batch
+
+    def _retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        batch = self.batches[batch_id]
+        if batch["status"] == "cancelling":
+            batch["status"] = "cancelled"
+            batch["cancelled_at"] = int(time.time())
+        elif batch["status"] in ("validating", "in_progress"):
+            batch["retrieves"] = batch.get("retrieves", 0) + 1
+            elapsed = time.monotonic() - self._created_at[batch_id]
+            if elapsed < self.validation_delay:
+                pass
+            elif batch_id in self._failing_batches:
+                batch["status"] = "failed"
+                batch["failed_at"] = int(time.time())
+                batch["errors"] = {"object": "list", "data": [
+                    {"code": "invalid_request", "message": "Injected batch failure"}]}
+            elif (
+                    batch["retrieves"] >= self.retrieves_to_complete
+                    and elapsed >= self.validation_delay + self.processing_delay
+            ):
+                self._process(batch)
+            else:
+                batch["status"] = "in_progress"
+        return batch
+
+    async def _stream(self, content: bytes):
+        for start in range(0, len(content), self.chunk_size):
+            yield content[start:start + self.chunk_size]
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        parts = request.url.path.split("/")[2:]  # strip leading "/v1"
+        method = request.method
+        if self.http_failure_rate and self._random.random() < self.http_failure_rate:
+            self._count("http_failures")
+            return httpx.Response(500, json={"error": {"message": "Injected server error"}})
+        if method == "POST" and parts == ["files"]:
+            self._count("files.create")
+            return httpx.Response(200, json=self._upload(request))
+        if len(parts) >= 2 and (
+                parts[0] == "files" and method == "GET" and parts[1] not in self.files
+                or parts[0] == "batches" and parts[1] not in self.batches
+        ):
+            return httpx.Response(404, json={"error": {"message": f"No such object: {parts[1]}"}})
+        if method == "GET" and len(parts) == 3 and parts[0] == "files" and parts[2] == "content":
+            self._count("files.content")
+            return httpx.Response(200, content=self._stream(self.files[parts[1]]))
+        if method == "DELETE" and len(parts) == 2 and parts[0] == "files":
+            self._count("files.delete")
+            self.files.pop(parts[1], None)
+            return httpx.Response(200, json={"id": parts[1], "object": "file", "deleted": True})
+        if method == "POST" and parts == ["batches"]:
+            self._count("batches.create")
+            return httpx.Response(200, json=self._create_batch(request))
+        if method == "POST" and len(parts) == 3 and parts[0] == "batches" and parts[2] == "cancel":
+            self._count("batches.cancel")
+            return httpx.Response(200, json=self._cancel_batch(parts[1]))
+        if method == "POST" and parts == ["chat", "completions"]:
+            self._count("chat.completions")
+            try:
+                return httpx.Response(200, json=self.responder(json.loads(request.content)))
+            except Exception as e:
+                return httpx.Response(getattr(e, "status_code", 400), json={"error": {"message": str(e)}})
+        if method == "GET" and len(parts) == 2 and parts[0] == "batches":
+            self._count("batches.retrieve")
+            if self.retrieve_errors:
+                return httpx.Response(self.retrieve_errors.pop(0), json={"error": {"message": "Injected error"}})
+            return httpx.Response(200, json=self._retrieve_batch(parts[1]))
+        return httpx.Response(404, json={"error": {"message": f"{method} {request.url.path} is not faked"}})
@@ -0,0 +1,130 @@
+import json
+import re
+from typing import Callable, Sequence, Tuple, Dict, Any, List, TypeVar, Iterator
+
+T = TypeVar("T")
+
+_FENCED_BLOCK = re.compile(r"```[a-zA-Z]*\s*\n?(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_BARE_WORD = re.compile(r"(?<![\w.])([A-Za-z_][A-Za-z0-9_]*)(?![\w.])")
+_JSON_WORDS = {"true", "false", "null", "NaN", "Infinity"}
+_PYTHON_WORDS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _split_strings(text: str) -> Iterator[Tuple[bool, str]]:
+    """Splits text into (is_string, segment) pairs, strings are quoted with " or ' and keep their quotes."""
+    start = 0
+    i = 0
+    while i < len(text):
+        quote = text[i]
+        if quote not in "\"'":
+            i += 1
+            continue
+        if i > start:
+            yield False, text[start:i]
+        end = i + 1
+        while end < len(text) and text[end] != quote:
+            end += 2 if text[end] == "\\" else 1
+        yield True, text[i:end + 1]
+        start = i = end + 1
+    if start < len(text):
+        yield False, text[start:]
+
+
+def _map_outside_strings(text: str, repair: Callable[[str], str]) -> str:
+    return "".join(segment if is_string else repair(segment) for is_string, segment in _split_strings(text))
+
+
+def extract_json(text: str) -> str:
+    """Drops code fences and prose around the outermost JSON object or list."""
+    fenced = _FENCED_BLOCK.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    end = max(text.rfind("}"), text.rfind("]"))
+    if not starts or end < min(starts):
+        return text.strip()
+    return text[min(starts):end + 1]
+
+
+def double_quote_strings(text: str) -> str:
+    """Converts 'single quoted' strings to JSON strings."""
+    def convert(is_string: bool, segment: str) -> str:
+        if not is_string or not segment.startswith("'"):
+            return segment
+        content = segment[1:-1] if len(segment) > 1 and segment.endswith("'") else segment[1:]
+        return '"' + content.replace("\\'", "'").replace('"', '\\"') + '"'
+
+    return "".join(convert(is_string, segment) for is_string, segment in _split_strings(text))
+
+
+def remove_trailing_commas(text: str) -> str:
+    return _map_outside_strings(text, lambda segment: _TRAILING_COMMA.sub(r"\1", segment))
+
+
+def quote_bare_words(text: str) -> str:
+    """Replaces Python literals with JSON ones and quotes other bare words (placeholders like int_value, keys)."""
+    def replace(match: re.Match) -> str:
+        word = match.group(1)
+        if word in _JSON_WORDS:
+            return word
+        return _PYTHON_WORDS.get(word, json.dumps(word))
+
+    return _map_outside_strings(text, lambda segment: _BARE_WORD.sub(replace, segment))
+
+
+def wrap_in_list(text: str) -> str:
+    """Wraps a bare object where a list is expected."""
+    stripped = text.strip()
+    return f"[{stripped}]" if stripped.startswith("{") else text
+
+
+DEFAULT_REPAIRS: Sequence[Tuple[str, Callable[[str], str]]] = (
+    ("extract_json", extract_json),
+    ("double_quote_strings", double_quote_strings),
+    ("remove_trailing_commas", remove_trailing_commas),
+    ("quote_bare_words", quote_bare_words),
+    ("wrap_in_list", wrap_in_list),
+)
+
+
+class OutputRepairer:
+    """
+    Deterministic local fixes of almost-valid JSON outputs, tried before asking llm to re-format its answer.
+    Repairs are applied cumulatively in order and parsing is retried after each one that changed the text.
+    stats() reports how often repairs helped (overall and per repair).
+    """
+
+    def __init__(self, repairs: Sequence[Tuple[str, Callable[[str], str]]] = DEFAULT_REPAIRS):
+        self.repairs = repairs
+        self.attempts = 0
+        self.repaired = 0
+        self.hits: Dict[str, int] = {name: 0 for name, _ in repairs}
+
+    def repair(self, text: str, parse: Callable[[str], T], error: Exception) -> T:
+        """Returns parse result of the repaired text or raises the original parsing error."""
+        self.attempts += 1
+        applied: List[str] = []
+        for name, repair in self.repairs:
+            repaired_text = repair(text)
+            if repaired_text == text:
+                continue
+            text = repaired_text
+            applied.append(name)
+            try:
+                result = parse(text)
+            except Exception:
+                continue
+            self.repaired += 1
+            for applied_name in applied:
+                self.hits[applied_name] += 1
+            return result
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "attempts": self.attempts,
+            "repaired": self.repaired,
+            "hit_rate": self.repaired / self.attempts if self.attempts else 0.0,
+            "hits": dict(self.hits),
+        }
@@ -1,33 +1,97 @@
+import asyncio
 import copy
-from typing import Optional, Any
+import json
+from collections import Counter
+from typing import Optional, Any, List, Union, Set, Dict, Callable, Tuple, Iterator, AsyncIterator
 
 from langchain_core.exceptions import OutputParserException
 from langchain_core.language_models import BaseChatModel, LanguageModelInput, LanguageModelOutput
-from langchain_core.messages import AIMessage, ToolMessage, HumanMessage
+from langchain_core.messages import AIMessage, ToolMessage, HumanMessage, BaseMessage
 from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import get_config_list, ensure_config
 from langchain_core.runnables.utils import Input, Output
 
+from yid_langchain_extensions.llm.output_repair import OutputRepairer
+from yid_langchain_extensions.llm.stream_validation import JsonStreamValidator
+
 ASK_TO_REFORMAT_PROMPT = PromptTemplate.from_template(
     "Thank you for your answer, but it does not follow the output formatting instructions. "
     "The following error occurred:\nOutput parsing error:\n{error_message}\n\n"
     "Right now you HAVE TO *RE-FORMAT* your answer to meet the requirements and to fix the error!!!. "
     "NOTE: NO NEED to re-do the job, just re-format it properly!!!"
 )
+COMPACT_REFORMAT_PROMPT = PromptTemplate.from_template(
+    "The answer below does not follow the output formatting instructions.\n"
+    "Output formatting instructions:\n{format_instructions}\n\n"
+    "Answer:\n{bad_output}\n\n"
+    "Output parsing error:\n{error_message}\n\n"
+    "Re-format the answer to meet the instructions and to fix the error. "
+    "Do not change its meaning and return nothing but the re-formatted answer."
+)
 
 
 class LLMWithParsingRetry(Runnable[LanguageModelInput, Any]):
+    """
+    Calls llm and parses its output, asking llm to re-format the answer (up to max_retries times) on parsing errors.
+    batch/abatch run retries in waves: all inputs go to one llm.batch call,
+     then all items failed to parse go to the next one, so the underlying model batching is kept for retries.
+    If repairer is set, outputs failed to parse are first repaired locally (trailing commas, quotes, code fences, ...)
+     and llm is asked to re-format only if no repair produced a parseable output.
+    Retries are made by repair_llm if set (e.g. a cheaper model) and by llm otherwise.
+    By default a retry re-sends the whole conversation extended with the bad answer and reformat_prompt.
+    With compact_retries it sends only compact_reformat_prompt with format instructions (format_instructions
+     or parser.get_format_instructions()), the bad answer and the error, so its size does not depend on the input.
+    ainvoke can trade tokens for tail latency (see hedge_stats() for how often it paid off):
+     with hedges > 1 up to hedges independent attempts (each with its own retries) run in parallel,
+     the next one is launched after hedge_delay seconds without success (or right away if it is 0)
+     or as soon as a running attempt fails; the first parsed output wins and the other attempts are cancelled.
+     With candidates > 1 the first llm call asks for that many completions at once (n parameter)
+     and they are parsed in order, retrying only if none of them parses; llm must then be a BaseChatModel
+     (a runnable like model.bind_tools(...) returns only one generation).
+    With stream_validator (a factory of validators like JsonStreamValidator) llm output is streamed
+     and the generation is stopped as soon as the validator rejects it, the retry starts right away.
+    stream/astream yield parser outputs as they come (partial ones for streaming parsers like JsonOutputParser),
+     the whole output is then parsed to check it, and yielded once more if only the repairer could parse it.
+     Outputs already yielded by a rejected attempt are not taken back: the stream goes on with outputs of the retry.
+     So with cumulative parsers (JsonOutputParser, PydanticOutputParser) only the last output is the result,
+     and delta parsers (StrOutputParser) should be streamed only with max_retries=0 (or use invoke).
+    """
+
     def __init__(
             self, llm: BaseChatModel, parser: Runnable[LanguageModelOutput, Any],
             max_retries: int = 1, exceptions_to_retry: tuple[type[Exception]] = (OutputParserException,),
             reformat_prompt: PromptTemplate = ASK_TO_REFORMAT_PROMPT,
+            repairer: Optional[OutputRepairer] = None,
+            repair_llm: Optional[BaseChatModel] = None,
+            compact_retries: bool = False,
+            compact_reformat_prompt: PromptTemplate = COMPACT_REFORMAT_PROMPT,
+            format_instructions: Optional[str] = None,
+            hedges: int = 1,
+            hedge_delay: float = 0.0,
+            candidates: int = 1,
+            stream_validator: Optional[Callable[[], JsonStreamValidator]] = None,
     ):
+        if candidates > 1 and not isinstance(llm, BaseChatModel):
+            raise ValueError(f"candidates > 1 requires llm to be a BaseChatModel, got {type(llm).__name__}")
         self.llm = llm
         self.parser = parser
         self.max_retries = max_retries
         self.exceptions_to_retry = exceptions_to_retry
         self.reformat_prompt = reformat_prompt
+        self.repairer = repairer
+        self.repair_llm = repair_llm or llm
+        self.compact_retries = compact_retries
+        self.compact_reformat_prompt = compact_reformat_prompt
+        self.format_instructions = format_instructions
+        self.hedges = hedges
+        self.hedge_delay = hedge_delay
+        self.candidates = candidates
+        self.stream_validator = stream_validator
+        self.hedged_invocations = 0
+        self.hedge_wins: Counter = Counter()
+        self.candidate_wins: Counter = Counter()
 
     def _extend_input(
             self, input: LanguageModelInput, bad_result: LanguageModelOutput, error_message: str
@@ -57,30 +121,375 @@ class LLMWithParsingRetry(Runnable[LanguageModelInput, Any]):
             return input_copy
         raise NotImplementedError(f"type {type(input)} not supported")
 
+    def _retries_exhausted(self, aggregated_error: str) -> OutputParserException:
+        return OutputParserException(
+            f"Failed to parse LLM output after {self.max_retries} retries:\n{aggregated_error}")
+
+    def _get_format_instructions(self) -> str:
+        if self.format_instructions is None:
+            # composed runnables (e.g. parser | RunnableLambda) have no format instructions at all
+            get_format_instructions = getattr(self.parser, "get_format_instructions", None)
+            try:
+                self.format_instructions = get_format_instructions() if get_format_instructions is not None else None
+            except NotImplementedError:
+                pass
+            self.format_instructions = self.format_instructions or "(see the error message)"
+        return self.format_instructions
+
+    def _compact_input(self, bad_result: LanguageModelOutput, error_message: str) -> LanguageModelInput:
+        bad_output = bad_result if isinstance(bad_result, str) else bad_result.content
+        if isinstance(bad_result, AIMessage) and bad_result.tool_calls and not bad_output:
+            bad_output = json.dumps(
+                [{"name": tool_call["name"], "arguments": tool_call["args"]} for tool_call in bad_result.tool_calls])
+        return [HumanMessage(content=self.compact_reformat_prompt.format(
+            format_instructions=self._get_format_instructions(), bad_output=bad_output, error_message=error_message
+        ))]
+
+    def _retry_input(
+            self, input: LanguageModelInput, bad_result: LanguageModelOutput, error_message: str
+    ) -> LanguageModelInput:
+        if self.compact_retries:
+            return self._compact_input(bad_result, error_message)
+        return self._extend_input(input, bad_result, error_message)
+
+    @staticmethod
+    def _with_content(llm_output: LanguageModelOutput, content: str) -> LanguageModelOutput:
+        if isinstance(llm_output, BaseMessage):
+            return llm_output.model_copy(update={"content": content})
+        return content
+
+    def _repair(
+            self, llm_output: LanguageModelOutput, error: Exception, config: Optional[RunnableConfig], **kwargs: Any
+    ) -> Any:
+        content = llm_output if isinstance(llm_output, str) else llm_output.content
+        if self.repairer is None or not isinstance(content, str):
+            raise error
+        return self.repairer.repair(
+            content, lambda text: self.parser.invoke(self._with_content(llm_output, text), config, **kwargs), error)
+
+    def _parse(self, llm_output: LanguageModelOutput, config: Optional[RunnableConfig], **kwargs: Any) -> Any:
+        try:
+            return self.parser.invoke(llm_output, config, **kwargs)
+        except self.exceptions_to_retry as e:
+            return self._repair(llm_output, e, config, **kwargs)
+
+    async def _aparse(self, llm_output: LanguageModelOutput, config: Optional[RunnableConfig], **kwargs: Any) -> Any:
+        try:
+            return await self.parser.ainvoke(llm_output, config, **kwargs)
+        except self.exceptions_to_retry as e:
+            return self._repair(llm_output, e, config, **kwargs)
+
+    @staticmethod
+    def _chunk_text(chunk: Any) -> str:
+        content = chunk if isinstance(chunk, str) else chunk.content
+        return content if isinstance(content, str) else ""
+
+    @staticmethod
+    def _add_chunk(llm_output: Optional[LanguageModelOutput], chunk: Any) -> LanguageModelOutput:
+        return chunk if llm_output is None else llm_output + chunk
+
+    def _generate_validated(
+            self, llm: BaseChatModel, input: Input, config: Optional[RunnableConfig], **kwargs: Any
+    ) -> Tuple[LanguageModelOutput, Optional[str]]:
+        """Streams llm output through a new validator, returns the output and the rejection reason if any."""
+        validator = self.stream_validator()
+        llm_output = None
+        stream = llm.stream(input, config, **kwargs)
+        try:
+            for chunk in stream:
+                llm_output = self._add_chunk(llm_output, chunk)
+                if not validator.feed(self._chunk_text(chunk)):
+                    return llm_output, validator.error
+        finally:
+            stream.close()
+        return llm_output, None
+
+    async def _agenerate_validated(
+            self, llm: BaseChatModel, input: Input, config: Optional[RunnableConfig], **kwargs: Any
+    ) -> Tuple[LanguageModelOutput, Optional[str]]:
+        validator = self.stream_validator()
+        llm_output = None
+        stream = llm.astream(input, config, **kwargs)
+        try:
+            async for chunk in stream:
+                llm_output = self._add_chunk(llm_output, chunk)
+                if not validator.feed(self._chunk_text(chunk)):
+                    return llm_output, validator.error
+        finally:
+            await stream.aclose()
+        return llm_output, None
+
     def invoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
         aggregated_error = ""
         extended_input = input
-        for _ in range(self.max_retries + 1):
-            llm_output = self.llm.invoke(extended_input, config, **kwargs)
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            rejection = None
+            if self.stream_validator is not None:
+                llm_output, rejection = self._generate_validated(llm, extended_input, config, **kwargs)
+            else:
+                llm_output = llm.invoke(extended_input, config, **kwargs)
             try:
-                parser_output = self.parser.invoke(llm_output, config, **kwargs)
+                if rejection is not None:
+                    raise OutputParserException(rejection)
+                parser_output = self._parse(llm_output, config, **kwargs)
                 return parser_output
             except self.exceptions_to_retry as e:
                 aggregated_error += str(e) + "\n\n"
-                extended_input = self._extend_input(extended_input, llm_output, str(e))
-        raise OutputParserException(f"Failed to parse LLM output after {self.max_retries} retries:\n{aggregated_error}")
+                extended_input = self._retry_input(extended_input, llm_output, str(e))
+        raise self._retries_exhausted(aggregated_error)
+
+    def stream(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Output]:
+        aggregated_error = ""
+        extended_input = input
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            validator = self.stream_validator() if self.stream_validator is not None else None
+            llm_output = None
+
+            def llm_chunks() -> Iterator[Any]:
+                nonlocal llm_output
+                stream = llm.stream(extended_input, config, **kwargs)
+                try:
+                    for chunk in stream:
+                        llm_output = self._add_chunk(llm_output, chunk)
+                        if validator is not None and not validator.feed(self._chunk_text(chunk)):
+                            return
+                        yield chunk
+                finally:
+                    stream.close()
+
+            try:
+                for output in self.parser.transform(llm_chunks(), config):
+                    yield output
+                if validator is not None and validator.error is not None:
+                    raise OutputParserException(validator.error)
+                # outputs may be deltas (e.g. StrOutputParser), so the whole output is parsed only to check it,
+                # unless the streamed outputs could not have reached the repaired one
+                try:
+                    self.parser.invoke(llm_output, config, **kwargs)
+                except self.exceptions_to_retry as e:
+                    yield self._repair(llm_output, e, config, **kwargs)
+                return
+            except self.exceptions_to_retry as e:
+                error = validator.error if validator is not None and validator.error is not None else str(e)
+            aggregated_error += error + "\n\n"
+            extended_input = self._retry_input(extended_input, llm_output, error)
+        raise self._retries_exhausted(aggregated_error)
+
+    async def astream(
+            self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Output]:
+        aggregated_error = ""
+        extended_input = input
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            validator = self.stream_validator() if self.stream_validator is not None else None
+            llm_output = None
+
+            async def llm_chunks() -> AsyncIterator[Any]:
+                nonlocal llm_output
+                stream = llm.astream(extended_input, config, **kwargs)
+                try:
+                    async for chunk in stream:
+                        llm_output = self._add_chunk(llm_output, chunk)
+                        if validator is not None and not validator.feed(self._chunk_text(chunk)):
+                            return
+                        yield chunk
+                finally:
+                    await stream.aclose()
+
+            try:
+                async for output in self.parser.atransform(llm_chunks(), config):
+                    yield output
+                if validator is not None and validator.error is not None:
+                    raise OutputParserException(validator.error)
+                # outputs may be deltas (e.g. StrOutputParser), so the whole output is parsed only to check it,
+                # unless the streamed outputs could not have reached the repaired one
+                try:
+                    await self.parser.ainvoke(llm_output, config, **kwargs)
+                except self.exceptions_to_retry as e:
+                    yield self._repair(llm_output, e, config, **kwargs)
+                return
+            except self.exceptions_to_retry as e:
+                error = validator.error if validator is not None and validator.error is not None else str(e)
+            aggregated_error += error + "\n\n"
+            extended_input = self._retry_input(extended_input, llm_output, error)
+        raise self._retries_exhausted(aggregated_error)
 
     async def ainvoke(
         self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any
     ) -> Output:
+        if self.hedges > 1:
+            return await self._ainvoke_hedged(input, config, **kwargs)
+        return await self._ainvoke_with_retries(input, config, **kwargs)
+
+    async def _asample_candidates(
+            self, input: Input, config: Optional[RunnableConfig], **kwargs: Any
+    ) -> List[BaseMessage]:
+        config = ensure_config(config)
+        llm_result = await self.llm.agenerate_prompt(
+            [self.llm._convert_input(input)],
+            callbacks=config.get("callbacks"),
+            tags=config.get("tags"),
+            metadata=config.get("metadata"),
+            run_name=config.get("run_name"),
+            n=self.candidates,
+            **kwargs,
+        )
+        return [generation.message for generation in llm_result.generations[0]]
+
+    async def _ainvoke_with_retries(self, input: Input, config: Optional[RunnableConfig], **kwargs: Any) -> Output:
         aggregated_error = ""
         extended_input = input
-        for _ in range(self.max_retries + 1):
-            llm_output = await self.llm.ainvoke(extended_input, config, **kwargs)
-            try:
-                parser_output = await self.parser.ainvoke(llm_output, config, **kwargs)
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            errors = []
+            if attempt == 0 and self.candidates > 1:
+                llm_outputs = await self._asample_candidates(input, config, **kwargs)
+            elif self.stream_validator is not None:
+                llm_output, rejection = await self._agenerate_validated(llm, extended_input, config, **kwargs)
+                llm_outputs = [llm_output]
+                if rejection is not None:
+                    errors.append(OutputParserException(rejection))
+            else:
+                llm_outputs = [await llm.ainvoke(extended_input, config, **kwargs)]
+            for index, llm_output in enumerate(llm_outputs if not errors else []):
+                try:
+                    parser_output = await self._aparse(llm_output, config, **kwargs)
+                except self.exceptions_to_retry as e:
+                    errors.append(e)
+                    continue
+                if attempt == 0 and self.candidates > 1:
+                    self.candidate_wins[index] += 1
                 return parser_output
-            except self.exceptions_to_retry as e:
-                aggregated_error += str(e) + "\n\n"
-                extended_input = self._extend_input(extended_input, llm_output, str(e))
-        raise OutputParserException(f"Failed to parse LLM output after {self.max_retries} retries:\n{aggregated_error}")
+            aggregated_error += str(errors[0]) + "\n\n"
+            extended_input = self._retry_input(extended_input, llm_outputs[0], str(errors[0]))
+        raise self._retries_exhausted(aggregated_error)
+
+    async def _ainvoke_hedged(self, input: Input, config: Optional[RunnableConfig], **kwargs: Any) -> Output:
+        self.hedged_invocations += 1
+        attempts: List[asyncio.Future] = []
+        running: Set[asyncio.Future] = set()
+        errors = []
+        try:
+            while True:
+                if len(attempts) < self.hedges:
+                    attempt = asyncio.ensure_future(self._ainvoke_with_retries(input, config, **kwargs))
+                    attempts.append(attempt)
+                    running.add(attempt)
+                    if self.hedge_delay <= 0:
+                        continue
+                timeout = self.hedge_delay if len(attempts) < self.hedges else None
+                done, running = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in sorted(done, key=attempts.index):
+                    if attempt.exception() is None:
+                        self.hedge_wins[attempts.index(attempt)] += 1
+                        return attempt.result()
+                    errors.append(attempt.exception())
+                if not running and len(attempts) == self.hedges:
+                    raise errors[0]
+        finally:
+            for attempt in running:
+                attempt.cancel()
+
+    def hedge_stats(self) -> Dict[str, Any]:
+        """How often hedged attempts (index > 0) and extra candidates (index > 0) won."""
+        hedge_successes = sum(self.hedge_wins.values())
+        candidate_successes = sum(self.candidate_wins.values())
+        return {
+            "hedged_invocations": self.hedged_invocations,
+            "hedge_wins": dict(self.hedge_wins),
+            "hedge_win_rate": (hedge_successes - self.hedge_wins[0]) / hedge_successes if hedge_successes else 0.0,
+            "candidate_wins": dict(self.candidate_wins),
+            "candidate_win_rate": (
+                (candidate_successes - self.candidate_wins[0]) / candidate_successes if candidate_successes else 0.0
+            ),
+        }
+
+    def _try_parse(self, llm_output: LanguageModelOutput, config: RunnableConfig, **kwargs: Any) -> Any:
+        try:
+            return self._parse(llm_output, config, **kwargs)
+        except Exception as e:
+            return e
+
+    async def _atry_parse(self, llm_output: LanguageModelOutput, config: RunnableConfig, **kwargs: Any) -> Any:
+        try:
+            return await self._aparse(llm_output, config, **kwargs)
+        except Exception as e:
+            return e
+
+    def _next_wave(
+            self, inputs: List[Input], wave: List[int], llm_outputs: List[Any], parser_outputs: List[Any],
+            results: List[Any], errors: List[str]
+    ) -> List[int]:
+        """Stores results of the wave and returns indices of inputs to retry (with their inputs extended)."""
+        retry = []
+        for i, llm_output, parser_output in zip(wave, llm_outputs, parser_outputs):
+            if isinstance(parser_output, self.exceptions_to_retry) and not isinstance(llm_output, Exception):
+                errors[i] += str(parser_output) + "\n\n"
+                inputs[i] = self._retry_input(inputs[i], llm_output, str(parser_output))
+                retry.append(i)
+            else:
+                results[i] = parser_output
+        return retry
+
+    def _finish_batch(
+            self, wave: List[int], results: List[Any], errors: List[str], return_exceptions: bool
+    ) -> List[Any]:
+        for i in wave:
+            results[i] = self._retries_exhausted(errors[i])
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def batch(
+            self, inputs: List[Input], config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+            *, return_exceptions: bool = False, **kwargs: Optional[Any]
+    ) -> List[Output]:
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        inputs = list(inputs)
+        results: List[Any] = [None] * len(inputs)
+        errors = [""] * len(inputs)
+        wave = list(range(len(inputs)))
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            llm_outputs = llm.batch(
+                [inputs[i] for i in wave], [configs[i] for i in wave], return_exceptions=return_exceptions, **kwargs)
+            parser_outputs = [
+                llm_output if isinstance(llm_output, Exception) else self._try_parse(llm_output, configs[i], **kwargs)
+                for i, llm_output in zip(wave, llm_outputs)
+            ]
+            wave = self._next_wave(inputs, wave, llm_outputs, parser_outputs, results, errors)
+            if not wave:
+                break
+        return self._finish_batch(wave, results, errors, return_exceptions)
+
+    async def abatch(
+            self, inputs: List[Input], config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+            *, return_exceptions: bool = False, **kwargs: Optional[Any]
+    ) -> List[Output]:
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        inputs = list(inputs)
+        results: List[Any] = [None] * len(inputs)
+        errors = [""] * len(inputs)
+        wave = list(range(len(inputs)))
+        for attempt in range(self.max_retries + 1):
+            llm = self.repair_llm if attempt else self.llm
+            llm_outputs = await llm.abatch(
+                [inputs[i] for i in wave], [configs[i] for i in wave], return_exceptions=return_exceptions, **kwargs)
+            parser_outputs = await asyncio.gather(*(
+                self._atry_parse(llm_output, configs[i], **kwargs) if not isinstance(llm_output, Exception)
+                else asyncio.sleep(0, llm_output)
+                for i, llm_output in zip(wave, llm_outputs)
+            ))
+            wave = self._next_wave(inputs, wave, llm_outputs, parser_outputs, results, errors)
+            if not wave:
+                break
+        return self._finish_batch(wave, results, errors, return_exceptions)
@@ -0,0 +1,76 @@
+from typing import List, Optional
+
+_CLOSING = {"}": "{", "]": "["}
+
+
+class JsonStreamValidator:
+    """
+    Incremental check that a streamed output is a JSON object or list, optionally inside a code fence.
+    feed() returns False as soon as the text seen so far cannot start such output
+     (prose before the json, mismatched brackets), error then describes the problem.
+    Text after the end of the json is not checked.
+    Checking is linear in the output length: each chunk is scanned once.
+    """
+
+    def __init__(self):
+        self.error: Optional[str] = None
+        self._position = 0
+        self._backticks = 0
+        self._fence_opened = False
+        self._in_fence_tag = False
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._finished = False
+
+    def _reject(self, message: str) -> bool:
+        self.error = f"{message} (at position {self._position} of the output)"
+        return False
+
+    def _feed_preamble(self, char: str) -> bool:
+        if self._in_fence_tag:
+            self._in_fence_tag = char != "\n"
+            return True
+        if char == "`" and not self._fence_opened:
+            self._backticks += 1
+            if self._backticks == 3:
+                self._fence_opened = True
+                self._in_fence_tag = True
+            return True
+        if self._backticks not in (0, 3):
+            return self._reject("Broken code fence")
+        if char.isspace():
+            return True
+        if char in "{[":
+            self._stack.append(char)
+            return True
+        return self._reject(f"Expected a JSON object or list, got {char!r}")
+
+    def _feed_json(self, char: str) -> bool:
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+        elif char == '"':
+            self._in_string = True
+        elif char in "{[":
+            self._stack.append(char)
+        elif char in _CLOSING:
+            if self._stack.pop() != _CLOSING[char]:
+                return self._reject(f"Mismatched {char!r} in JSON")
+            self._finished = not self._stack
+        return True
+
+    def feed(self, text: str) -> bool:
+        if self.error is not None:
+            return False
+        for char in text:
+            if self._finished:
+                return True
+            if not (self._feed_json(char) if self._stack else self._feed_preamble(char)):
+                return False
+            self._position += 1
+        return True
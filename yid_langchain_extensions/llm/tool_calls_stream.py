@@ -0,0 +1,284 @@
+import json
+from typing import Tuple, Optional, List, Dict, Any, Callable
+
+from langchain_core.messages import AIMessageChunk
+from langchain_core.messages.tool import ToolCallChunk, tool_call_chunk
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+_OPENING = {"}": "{", "]": "["}
+
+
+class _WhitespaceTrimmer:
+    """Drops leading whitespace of a stream and holds back the trailing one until more text follows."""
+
+    def __init__(self):
+        self.started = False
+        self.held = ""
+
+    def feed(self, text: str) -> str:
+        text = self.held + text
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        stripped = text.rstrip()
+        self.held = text[len(stripped):]
+        return stripped
+
+
+class ThinkSplitter:
+    """
+    Splits a stream into thoughts of the leading <think> block and the output after it.
+    Only a possible partial tag (a few chars) is kept between chunks, so nothing is ever rescanned.
+    Unlike split_thinking_and_output, the <think> tag is recognized only at the start of the text.
+    """
+
+    def __init__(self):
+        self.in_thoughts: Optional[bool] = None
+        self.pending = ""
+
+    def feed(self, text: str) -> Tuple[str, str]:
+        """Returns (thoughts, output) parts of the chunk."""
+        text = self.pending + text
+        self.pending = ""
+        if self.in_thoughts is None:
+            stripped = text.lstrip()
+            if THINK_START.startswith(stripped):
+                self.pending = stripped
+                return "", ""
+            self.in_thoughts = stripped.startswith(THINK_START)
+            if not self.in_thoughts:
+                return "", text
+            text = stripped[len(THINK_START):]
+        if not self.in_thoughts:
+            return "", text
+        end = text.find(THINK_END)
+        if end != -1:
+            self.in_thoughts = False
+            return text[:end], text[end + len(THINK_END):]
+        for size in range(min(len(THINK_END) - 1, len(text)), 0, -1):
+            if THINK_END.startswith(text[-size:]):
+                self.pending = text[-size:]
+                return text[:-size], ""
+        return text, ""
+
+    def finish(self) -> Tuple[str, str]:
+        """Returns what was held back as a possible tag start."""
+        pending, self.pending = self.pending, ""
+        return (pending, "") if self.in_thoughts else ("", pending)
+
+
+class ToolCallsJsonScanner:
+    """
+    Resumable scanner of tool calls json: a call {"name": ..., "arguments": {...}} or a list of such calls.
+    Each char is looked at once, feed() returns tool call chunks for what arrived:
+     id with the first chunk of a call, name once it is complete and raw json text of arguments as it streams.
+    done is set when the json is closed, error when it is malformed.
+    """
+
+    def __init__(self, new_id: Callable[[], str]):
+        self.new_id = new_id
+        self.done = False
+        self.error: Optional[str] = None
+        self.calls: List[Dict[str, Any]] = []
+        self._stack: List[str] = []
+        self._call_depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._token: Optional[List[str]] = None
+        self._key: Optional[str] = None
+        self._expect_key = False
+        self._expect_value = False
+        self._in_args = False
+        self._updates: Dict[int, ToolCallChunk] = {}
+
+    def _update(self, name: Optional[str] = None, args: str = ""):
+        index = len(self.calls) - 1
+        call = self.calls[index]
+        if index not in self._updates:
+            self._updates[index] = tool_call_chunk(
+                name=None, args=None, id=None if call["announced"] else call["id"], index=index)
+            call["announced"] = True
+        update = self._updates[index]
+        if name is not None:
+            call["name"] = update["name"] = name
+        if args:
+            call["args"].append(args)
+            update["args"] = (update["args"] or "") + args
+
+    def _start_call(self):
+        self.calls.append({"id": self.new_id(), "name": None, "args": [], "announced": False})
+        self._update()
+        self._expect_key = True
+        self._key = None
+
+    def _end_token(self):
+        raw = "".join(self._token)
+        self._token = None
+        try:
+            value = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            value = raw
+        if self._expect_key:
+            self._key = value
+            self._expect_key = False
+        else:
+            self._update(name=value)
+
+    def _fail(self, message: str) -> List[ToolCallChunk]:
+        self.error = message
+        return list(self._updates.values())
+
+    def feed(self, text: str) -> List[ToolCallChunk]:
+        self._updates = {}
+        if self.done or self.error is not None:
+            return []
+        args_from = 0 if self._in_args else None
+        for i, char in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._token is not None:
+                        self._end_token()
+                    continue
+                if self._token is not None:
+                    self._token.append(char)
+                continue
+            if char.isspace():
+                continue
+            at_call = bool(self._stack) and len(self._stack) == self._call_depth and self._stack[-1] == "{"
+            if self._in_args and at_call and char in ",}":
+                self._update(args=text[args_from:i])
+                self._in_args = False
+            if self._expect_value:
+                self._expect_value = False
+                if self._key == "arguments":
+                    self._in_args = True
+                    args_from = i
+                elif self._key == "name" and char == '"':
+                    self._token = []
+            if char == '"':
+                self._in_string = True
+                if self._expect_key and at_call:
+                    self._token = []
+            elif char in "{[":
+                if not self._stack:
+                    self._call_depth = 1 if char == "{" else 2
+                if char == "{" and len(self._stack) + 1 == self._call_depth:
+                    self._start_call()
+                self._stack.append(char)
+            elif char in _OPENING:
+                if not self._stack or self._stack.pop() != _OPENING[char]:
+                    return self._fail(f"Mismatched {char!r} in tool calls json")
+                if not self._stack:
+                    self.done = True
+                    break
+            elif at_call and char == ":":
+                self._expect_value = True
+            elif at_call and char == ",":
+                self._expect_key = True
+                self._key = None
+            elif not self._stack:
+                return self._fail(f"Expected a tool call json, got {char!r}")
+        if self._in_args:
+            self._update(args=text[args_from:])
+        return list(self._updates.values())
+
+    def check(self) -> Optional[str]:
+        """Error of the complete json (called once the stream ends): unclosed json, missing keys, invalid arguments."""
+        if self.error is not None:
+            return self.error
+        if not self.done:
+            return "Tool calls json is not complete"
+        for call in self.calls:
+            if call["name"] is None:
+                return "Expected key not found in output json: 'name'"
+            if not call["args"]:
+                return "Expected key not found in output json: 'arguments'"
+            try:
+                json.loads("".join(call["args"]))
+            except json.JSONDecodeError as e:
+                return f"Invalid arguments json of tool call {call['name']!r}: {e}"
+        return None
+
+
+class ToolCallsStream:
+    """
+    Incremental parser of a <think> block followed by tool calls json (optionally in a code fence) or plain text.
+    feed() turns a chunk of llm output into an AIMessageChunk (or None if there is nothing to emit yet):
+     thoughts go to additional_kwargs["thoughts"], tool calls to tool_call_chunks, a plain text answer to content.
+    Chunks sum up to a message equivalent to the one parsed from the whole text.
+    Every chunk is processed in time proportional to its own length.
+    """
+
+    def __init__(self, new_id: Callable[[], str]):
+        self.splitter = ThinkSplitter()
+        self.thoughts = _WhitespaceTrimmer()
+        self.text = _WhitespaceTrimmer()
+        self.scanner = ToolCallsJsonScanner(new_id)
+        self.is_json: Optional[bool] = None
+        self.preamble = ""
+
+    def _detect_json(self, output: str) -> str:
+        """Skips the code fence opening and decides whether the output is json, returns the rest of it."""
+        output = self.preamble + output
+        self.preamble = ""
+        stripped = output.lstrip()
+        if stripped.startswith("```"):
+            newline = stripped.find("\n")
+            if newline == -1:
+                self.preamble = stripped
+                return ""
+            stripped = stripped[newline + 1:].lstrip()
+        elif "```".startswith(stripped):
+            self.preamble = stripped
+            return ""
+        if stripped:
+            self.is_json = stripped[0] in "{["
+            return stripped if self.is_json else output
+        self.preamble = output
+        return ""
+
+    def _message(self, thoughts: str, output: str) -> Optional[AIMessageChunk]:
+        thoughts = self.thoughts.feed(thoughts) if thoughts else ""
+        if output and self.is_json is None:
+            output = self._detect_json(output)
+        content = ""
+        tool_call_chunks = []
+        if output and self.is_json:
+            tool_call_chunks = self.scanner.feed(output)
+        elif output:
+            content = self.text.feed(output)
+        if not (thoughts or content or tool_call_chunks):
+            return None
+        additional_kwargs = {"thoughts": thoughts} if thoughts else {}
+        return AIMessageChunk(content=content, additional_kwargs=additional_kwargs, tool_call_chunks=tool_call_chunks)
+
+    def feed(self, text: str) -> Optional[AIMessageChunk]:
+        return self._message(*self.splitter.feed(text))
+
+    def tool_call_chunks(self) -> List[ToolCallChunk]:
+        """Tool calls scanned so far, a whole call per chunk."""
+        return [
+            tool_call_chunk(name=call["name"], args="".join(call["args"]), id=call["id"], index=index)
+            for index, call in enumerate(self.scanner.calls)
+        ]
+
+    def finish(self) -> Tuple[AIMessageChunk, Optional[str]]:
+        """Returns the last chunk (always with thoughts key) and the parsing error of the whole output if any."""
+        thoughts, output = self.splitter.finish()
+        if self.is_json is None:
+            # a short output never recognized as json is a plain text answer
+            output = self.preamble + output
+            self.preamble = ""
+            self.is_json = False if output.strip() else None
+        last = AIMessageChunk(content="", additional_kwargs={"thoughts": ""})
+        message = self._message(thoughts, output)
+        if message is not None:
+            last += message
+        error = self.scanner.check() if self.is_json else "Output is not a tool calls json"
+        return last, error
@@ -0,0 +1,129 @@
+import json
+from typing import Any, Dict, Callable, List, Optional
+
+SCHEMA_NOISE = ("title",)
+
+
+def render_repr(tool: Dict[str, Any]) -> str:
+    """Python repr of the OpenAI tool dict (not valid json, the most verbose form)."""
+    return f"{tool}"
+
+
+def render_json(tool: Dict[str, Any]) -> str:
+    """Minified json of the function (name, description and parameters), without the OpenAI wrapper."""
+    return json.dumps(tool.get("function", tool), separators=(",", ":"), ensure_ascii=False)
+
+
+def _strip_schema(schema: Any) -> Any:
+    if isinstance(schema, list):
+        return [_strip_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    # boolean additionalProperties is noise (strict mode), a schema of dict values is not
+    stripped = {key: _strip_schema(value) for key, value in schema.items()
+                if key not in SCHEMA_NOISE and key != "properties"
+                and not (key == "additionalProperties" and isinstance(value, bool))}
+    if "properties" in schema:
+        required = set(schema.get("required", []))
+        stripped["properties"] = {
+            name: _strip_property(_strip_schema(value), name in required)
+            for name, value in schema["properties"].items()
+        }
+    return stripped
+
+
+def _strip_property(schema: Dict[str, Any], required: bool) -> Dict[str, Any]:
+    """Optional properties defaulting to null need neither the default nor the null alternative."""
+    if required or "default" not in schema or schema["default"] is not None:
+        return schema
+    schema = {key: value for key, value in schema.items() if key != "default"}
+    alternatives = [option for option in schema.get("anyOf", []) if option != {"type": "null"}]
+    if "anyOf" in schema and len(alternatives) == 1:
+        del schema["anyOf"]
+        schema.update(alternatives[0])
+    return schema
+
+
+def render_stripped(tool: Dict[str, Any]) -> str:
+    """
+    Minified json of the function without titles, boolean additionalProperties, strict
+     and null defaults (with null alternatives) of optional properties.
+    """
+    function = {key: value for key, value in tool.get("function", tool).items() if key != "strict"}
+    if "parameters" in function:
+        function["parameters"] = _strip_schema(function["parameters"])
+    return json.dumps(function, separators=(",", ":"), ensure_ascii=False)
+
+
+# TypeScript has no integer type, so the constraint is kept in a comment
+_TS_TYPES = {
+    "string": "string", "integer": "number /* integer */", "number": "number", "boolean": "boolean", "null": "null",
+}
+
+
+def _ts_union(types: List[str]) -> str:
+    return " | ".join(dict.fromkeys(types))
+
+
+def _ts_type(schema: Dict[str, Any]) -> str:
+    if "enum" in schema:
+        return _ts_union([json.dumps(value, ensure_ascii=False) for value in schema["enum"]])
+    if "const" in schema:
+        return json.dumps(schema["const"], ensure_ascii=False)
+    if "$ref" in schema:
+        return schema["$ref"].rsplit("/", 1)[-1]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return _ts_union([_ts_type(option) for option in schema[key]])
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return _ts_union([_ts_type({**schema, "type": option}) for option in schema_type])
+    if schema_type == "array":
+        items = _ts_type(schema.get("items", {}))
+        return f"({items})[]" if " | " in items or items.endswith("*/") else f"{items}[]"
+    if schema_type == "object" or "properties" in schema:
+        if not schema.get("properties"):
+            values = schema.get("additionalProperties")
+            return f"Record<string, {_ts_type(values)}>" if isinstance(values, dict) else "object"
+        required = set(schema.get("required", []))
+        fields = []
+        for name, value in schema["properties"].items():
+            comment = _ts_comment(value)
+            fields.append(_ts_field(name, value, name in required) + (f" /* {comment} */" if comment else ""))
+        return "{" + ", ".join(fields) + "}"
+    return _TS_TYPES.get(schema_type, "any")
+
+
+def _ts_field(name: str, schema: Dict[str, Any], required: bool) -> str:
+    return f"{name}{'' if required else '?'}: {_ts_type(schema)}"
+
+
+def _ts_comment(schema: Dict[str, Any]) -> Optional[str]:
+    parts = []
+    if schema.get("description"):
+        parts.append(" ".join(schema["description"].split()))
+    if schema.get("default") is not None:
+        parts.append(f"default: {json.dumps(schema['default'], ensure_ascii=False)}")
+    return ", ".join(parts) or None
+
+
+def render_typescript(tool: Dict[str, Any]) -> str:
+    """TypeScript-style signature: descriptions and defaults go to comments, optional arguments are marked with ?."""
+    function = tool.get("function", tool)
+    parameters = _strip_schema(function.get("parameters", {}))
+    required = set(parameters.get("required", []))
+    lines = [f"// {line}" for line in function.get("description", "").strip().splitlines() if line.strip()]
+    lines.append(f"type {function['name']} = (_: {{")
+    for name, schema in parameters.get("properties", {}).items():
+        comment = _ts_comment(schema)
+        lines.append(f"{_ts_field(name, schema, name in required)},{f' // {comment}' if comment else ''}")
+    lines.append("}) => any;")
+    return "\n".join(lines)
+
+
+TOOL_RENDERERS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "repr": render_repr,
+    "json": render_json,
+    "stripped": render_stripped,
+    "typescript": render_typescript,
+}
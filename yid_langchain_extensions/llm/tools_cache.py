@@ -0,0 +1,83 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, TypeVar, Union
+
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+T = TypeVar("T")
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache evicting least recently used entries beyond maxsize.
+    A value is created outside of the lock, so concurrent misses of the same key may create it twice.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key: Hashable, create: Callable[[], T]) -> T:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = create()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+def tool_key(tool: Union[Dict[str, Any], type, Callable, BaseTool]) -> Hashable:
+    """Schema hash for dict tools (equal schemas share an entry), identity for classes, functions and BaseTools."""
+    if isinstance(tool, dict):
+        return "schema", hashlib.sha256(json.dumps(tool, sort_keys=True, default=str).encode()).hexdigest()
+    return "id", id(tool)
+
+
+class OpenAIToolsCache:
+    """
+    LRU cache of convert_to_openai_tool results keyed by tool_key and strict.
+    Entries keep a reference to their tool, so an identity key is not reused by another object while it is cached.
+    Converted schemas are shared between callers and must not be modified.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.cache = LRUCache(maxsize)
+
+    def convert(
+            self, tool: Union[Dict[str, Any], type, Callable, BaseTool], strict: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        _, converted = self.cache.get_or_create(
+            (tool_key(tool), strict), lambda: (tool, convert_to_openai_tool(tool, strict=strict)))
+        return converted
+
+
+DEFAULT_TOOLS_CACHE = OpenAIToolsCache()
@@ -1,20 +1,26 @@
 import copy
+import json
 import secrets
 import string
 import typing
-from typing import Sequence, Union, Any, Callable, Optional
+from typing import Sequence, Union, Any, Callable, Optional, Iterator, AsyncIterator, List
 
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
 from langchain_core.exceptions import OutputParserException
 from langchain_core.language_models import LanguageModelInput, BaseChatModel
-from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, ToolCall, HumanMessage
+from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, ToolCall, HumanMessage, AIMessageChunk
+from langchain_core.messages.tool import tool_call_chunk
 from langchain_core.output_parsers import JsonOutputParser, BaseCumulativeTransformOutputParser
-from langchain_core.outputs import ChatResult
+from langchain_core.outputs import ChatResult, Generation, ChatGenerationChunk
 from langchain_core.prompt_values import ChatPromptValue
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_core.tools import BaseTool
-from langchain_core.utils.function_calling import convert_to_openai_tool
-from pydantic import Field
+from pydantic import Field, ConfigDict
+
+from yid_langchain_extensions.llm.output_repair import OutputRepairer
+from yid_langchain_extensions.llm.tool_calls_stream import ToolCallsStream
+from yid_langchain_extensions.llm.tool_renderers import render_repr
+from yid_langchain_extensions.llm.tools_cache import DEFAULT_TOOLS_CACHE, LRUCache, tool_key
 
 
 def add_tool_calls(base_input: LanguageModelInput, extra_message: str) -> LanguageModelInput:
@@ -51,13 +57,96 @@ def generate_call_id(length: int = 24, prefix: str = "call_") -> str:
 
 
 class DeepseekR1JsonToolCallsParser(BaseCumulativeTransformOutputParser[Any]):
+    """
+    Parses tool calls json (a call or a list of calls) following the <think> block.
+    If repairer is set, json failed to parse is repaired locally (trailing commas, quotes, ...) before giving up.
+    Streaming is incremental (see ToolCallsStream): AIMessageChunks with thoughts, tool_call_chunks
+     (arguments arrive as they are generated) or content are yielded, each llm chunk is processed once.
+    The last chunk carries parsing_error if the whole output is not a valid tool calls json.
+    With a repairer, tool calls are not streamed: the last chunk carries them whole, repaired if needed,
+     so that the sum of chunks never mixes broken arguments with repaired ones.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     base_json_parser: JsonOutputParser = Field(default_factory=JsonOutputParser)
     raise_if_cannot_parse: bool = False
+    repairer: Optional[OutputRepairer] = None
+
+    def _parse_json(self, output: str, repair: bool) -> Any:
+        try:
+            return self.base_json_parser.parse(output)
+        except OutputParserException as e:
+            if self.repairer is None or not repair:
+                raise
+            return self.repairer.repair(output, self.base_json_parser.parse, e)
+
+    def parse_result(self, result: list[Generation], *, partial: bool = False) -> AIMessage:
+        # partial outputs of a stream are not worth repairing, only the final one is
+        return self._parse(result[0].text, repair=not partial)
 
     def parse(self, text: str) -> AIMessage:
+        return self._parse(text, repair=True)
+
+    @staticmethod
+    def _chunk_text(chunk: Union[str, BaseMessage]) -> str:
+        content = chunk.content if isinstance(chunk, BaseMessage) else chunk
+        return content if isinstance(content, str) else ""
+
+    def _feed_stream(self, stream: ToolCallsStream, texts: List[str], chunk: Union[str, BaseMessage]
+                     ) -> Optional[AIMessageChunk]:
+        text = self._chunk_text(chunk)
+        message = stream.feed(text)
+        if self.repairer is None:
+            return message
+        # the text is kept to repair it once the stream ends, tool calls are held back until then
+        texts.append(text)
+        if message is None or not message.tool_call_chunks:
+            return message
+        if not (message.content or message.additional_kwargs):
+            return None
+        return AIMessageChunk(content=message.content, additional_kwargs=message.additional_kwargs)
+
+    def _finish_stream(self, stream: ToolCallsStream, texts: List[str]) -> AIMessageChunk:
+        last, error = stream.finish()
+        if self.repairer is not None:
+            tool_call_chunks = stream.tool_call_chunks()
+            if error is not None:
+                repaired = self._parse("".join(texts), repair=True)
+                error = repaired.additional_kwargs.get("parsing_error")
+                tool_call_chunks = [
+                    tool_call_chunk(name=call["name"], args=json.dumps(call["args"]), id=call["id"], index=index)
+                    for index, call in enumerate(repaired.tool_calls)
+                ]
+            last = AIMessageChunk(
+                content=last.content, additional_kwargs=last.additional_kwargs, tool_call_chunks=tool_call_chunks)
+        if error is not None:
+            if self.raise_if_cannot_parse:
+                raise OutputParserException(error)
+            last.additional_kwargs["parsing_error"] = error
+        return last
+
+    def _transform(self, input: Iterator[Union[str, BaseMessage]]) -> Iterator[AIMessageChunk]:
+        stream = ToolCallsStream(generate_call_id)
+        texts: List[str] = []
+        for chunk in input:
+            message = self._feed_stream(stream, texts, chunk)
+            if message is not None:
+                yield message
+        yield self._finish_stream(stream, texts)
+
+    async def _atransform(self, input: AsyncIterator[Union[str, BaseMessage]]) -> AsyncIterator[AIMessageChunk]:
+        stream = ToolCallsStream(generate_call_id)
+        texts: List[str] = []
+        async for chunk in input:
+            message = self._feed_stream(stream, texts, chunk)
+            if message is not None:
+                yield message
+        yield self._finish_stream(stream, texts)
+
+    def _parse(self, text: str, repair: bool) -> AIMessage:
         thoughts, output = split_thinking_and_output(text)
         try:
-            raw_tool_calls = self.base_json_parser.parse(output)
+            raw_tool_calls = self._parse_json(output, repair)
         except OutputParserException as e:
             if self.raise_if_cannot_parse:
                 raise e
@@ -65,6 +154,12 @@ class DeepseekR1JsonToolCallsParser(BaseCumulativeTransformOutputParser[Any]):
                 return AIMessage(content=output, additional_kwargs={"thoughts": thoughts, "parsing_error": str(e)})
         if isinstance(raw_tool_calls, dict):
             raw_tool_calls = [raw_tool_calls]
+        if not isinstance(raw_tool_calls, list) or not all(isinstance(call, dict) for call in raw_tool_calls):
+            # e.g. prose the repairer turned into a json string
+            error = f"Expected a tool call json, got {type(raw_tool_calls).__name__}"
+            if self.raise_if_cannot_parse:
+                raise OutputParserException(error)
+            return AIMessage(content=output, additional_kwargs={"thoughts": thoughts, "parsing_error": error})
 
         tool_calls = []
         try:
@@ -90,13 +185,25 @@ class ModelWithPromptIntroducedTools(BaseChatModel):
      but they are still smart enough to properly follow the schema.
     So you can use this wrapper for such models, to support binding tools for them.
     Tools will be introduced as part of the input prompt.
+    Generation (sync, async and streaming) is delegated to the native implementations of base_model.
+    Runnables introducing tools into the prompt are compiled once and shared by all wrapped models
+     (compiled_tools_cache, LRU by tools, tool_choice, strict and parallel_tool_calls),
+     so rebinding the same tools per request costs a lookup; tool schemas are converted via DEFAULT_TOOLS_CACHE.
+    tool_renderer writes each tool schema into the prompt, see tool_renderers.TOOL_RENDERERS
+     for more token-efficient forms (minified json, stripped json, TypeScript-style signatures).
     """
+    compiled_tools_cache: typing.ClassVar[LRUCache] = LRUCache(maxsize=256)
+
     base_model: BaseChatModel
+    tool_renderer: Callable[[dict[str, Any]], str] = render_repr
 
     @classmethod
-    def wrap_model(cls, base_model: BaseChatModel) -> "ModelWithPromptIntroducedTools":
+    def wrap_model(
+            cls, base_model: BaseChatModel, tool_renderer: Callable[[dict[str, Any]], str] = render_repr
+    ) -> "ModelWithPromptIntroducedTools":
         return ModelWithPromptIntroducedTools(
             base_model=base_model,
+            tool_renderer=tool_renderer,
             name=base_model.name,
             cache=base_model.cache,
             verbose=base_model.verbose,
@@ -113,6 +220,28 @@ class ModelWithPromptIntroducedTools(BaseChatModel):
                   run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
         return self.base_model._generate(messages, stop, run_manager, **kwargs)
 
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> ChatResult:
+        return await self.base_model._agenerate(messages, stop, run_manager, **kwargs)
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from self.base_model._stream(messages, stop, run_manager, **kwargs)
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.base_model._astream(messages, stop, run_manager, **kwargs):
+            yield chunk
+
+    def _should_stream(self, *, async_api: bool, run_manager: Optional[
+        Union[CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun]
+    ] = None, **kwargs: Any) -> bool:
+        # streaming methods are always overridden here, so only base_model knows whether it can stream
+        return self.base_model._should_stream(async_api=async_api, run_manager=run_manager, **kwargs)
+
     @property
     def _llm_type(self) -> str:
         return self.base_model._llm_type
@@ -128,16 +257,36 @@ class ModelWithPromptIntroducedTools(BaseChatModel):
             parallel_tool_calls: Optional[bool] = None,
             **kwargs: Any,
     ) -> Runnable[LanguageModelInput, BaseMessage]:
+        if tool_choice == "none":
+            return self
+        key = (
+            tuple(tool_key(tool) for tool in tools),
+            json.dumps(tool_choice, sort_keys=True) if isinstance(tool_choice, dict) else tool_choice,
+            strict,
+            parallel_tool_calls,
+            self.tool_renderer,
+        )
+        # tools are kept in the entry, so their identity keys stay valid while it is cached
+        _, introduce_tools = self.compiled_tools_cache.get_or_create(key, lambda: (tuple(tools), self._compile_tools(
+            tools, tool_choice, strict, parallel_tool_calls, self.tool_renderer)))
+        return introduce_tools | self
+
+    @staticmethod
+    def _compile_tools(
+            tools: Sequence[Union[dict[str, Any], type, Callable, BaseTool]],
+            tool_choice: Optional[Union[dict, str, bool]],
+            strict: Optional[bool],
+            parallel_tool_calls: Optional[bool],
+            tool_renderer: Callable[[dict[str, Any]], str],
+    ) -> Runnable[LanguageModelInput, LanguageModelInput]:
         formatted_tools = [
-            convert_to_openai_tool(tool, strict=strict) for tool in tools
+            DEFAULT_TOOLS_CACHE.convert(tool, strict=strict) for tool in tools
         ]
         formatted_tools = {
             tool["function"]["name"]: tool for tool in formatted_tools
         }
 
         match tool_choice:
-            case "none":
-                return self
             case "any" | "required":
                 if parallel_tool_calls:
                     suffix = ("Right now you should call one or several tools from this list. "
@@ -163,15 +312,14 @@ class ModelWithPromptIntroducedTools(BaseChatModel):
             case _:
                 raise ValueError("Unsupported value of tool_choice argument")
 
-        tools_intro = f"You have access to {len(formatted_tools)} tools with following schemas:\n"
-        for tool_name, formatted_tool in formatted_tools.items():
-            tools_intro += f"{formatted_tool}\n"
-        tools_intro += (f"\n{suffix}\nHint: before actually calling the tool,"
-                        f" think well, how are you going to call it. "
-                        f"During thinking, make sure you precisely follow the tool schema!!! ")
+        parts = [f"You have access to {len(formatted_tools)} tools with following schemas:\n"]
+        parts.extend(f"{tool_renderer(formatted_tool)}\n" for formatted_tool in formatted_tools.values())
+        parts.append(f"\n{suffix}\nHint: before actually calling the tool,"
+                     f" think well, how are you going to call it. "
+                     f"During thinking, make sure you precisely follow the tool schema!!! ")
 
         if parallel_tool_calls:
-            tools_intro += """
+            parts.append("""
 Example of tools calling:
 ```json
 [
@@ -191,9 +339,9 @@ Example of tools calling:
     },
 ]
 ```
-"""
+""")
         else:
-            tools_intro += """
+            parts.append("""
 Example of tool calling:
 ```json
 {
@@ -206,6 +354,7 @@ Example of tool calling:
     }
 }
 ```
-"""
+""")
 
-        return (lambda input: add_tool_calls(input, tools_intro)) | self
+        tools_intro = "".join(parts)
+        return RunnableLambda(lambda input: add_tool_calls(input, tools_intro))